@@ -0,0 +1,311 @@
+"""Benchmarks for the volume solver and the transfer compiler.
+
+Every benchmark runs on a synthetic workload scaled in the number of designs, components
+or deck size, or on the shipped flaviolin and indigoidine inputs, and records the best
+wall time over a few repeats, the throughput and the peak memory allocated (tracemalloc,
+which also sees NumPy buffers).
+
+    python benchmarks/run_benchmarks.py --quick
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --compare results.json --filter bulk
+
+With `--compare` the run is checked against an earlier `--output` file and exits with
+status 1 when a benchmark got slower (or used more memory) by more than `--threshold`.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import core
+import media_compiler as mc
+
+
+flaviolin_dir = os.path.join(root, 'data', 'flaviolin')
+indigoidine_deck = os.path.join(root, 'data', 'indigoidine', 'indigoidine_media.csv')
+
+well_volume = 300
+min_tip_volume = 0.5
+culture_ratio = 100
+
+
+class Benchmark(NamedTuple):
+    """One benchmark: `setup()` builds the arguments of `run`, excluded from the timing."""
+    name: str
+    setup: Callable
+    run: Callable
+    items: int          # work items per run (designs, volumes, transfers), for throughput
+
+
+class Result(NamedTuple):
+    name: str
+    seconds: float      # best wall time over the repeats
+    throughput: float   # items per second
+    peak_mb: float      # peak memory allocated during one run
+
+
+# Workloads
+
+def synthetic_stocks(n_components: int, seed: int=0) -> pd.DataFrame:
+    """Stock concentrations spread over several decades, low stocks 20x diluted."""
+    rng = np.random.default_rng(seed)
+    high = 10 ** rng.uniform(-2, 3, n_components)
+    return pd.DataFrame({'High Concentration': high, 'Low Concentration': high / 20},
+                        index=[f'C{i}' for i in range(n_components)])
+
+
+def synthetic_targets(df_stock: pd.DataFrame, n_designs: int, seed: int=0) -> pd.DataFrame:
+    """Targets log-uniform below the high stocks, a mix of feasible and infeasible designs."""
+    rng = np.random.default_rng(seed)
+    high = df_stock['High Concentration'].values
+    n = len(high)
+    log_ratio = rng.uniform(np.log10(1 / 5000), np.log10(1 / (2 * n)), (n_designs, n))
+    return pd.DataFrame(high * 10 ** log_ratio, columns=df_stock.index)
+
+
+def flaviolin_fixture():
+    """Stocks, standard recipe and bounds of the flaviolin project (Kan is left out)."""
+    df_stock = core.read_stock_concentrations(os.path.join(flaviolin_dir, 'stock_concentrations.csv')).drop('Kan')
+    df_stand = pd.read_csv(os.path.join(flaviolin_dir, 'standard_recipe_concentrations.csv'),
+                           index_col='Component').drop('Kan')
+    df_bounds = pd.read_csv(os.path.join(flaviolin_dir, 'Putida_media_bounds.csv'), index_col='Variable')
+    return df_stock, df_stand, df_bounds
+
+
+def flaviolin_targets(n_designs: int, seed: int=0) -> pd.DataFrame:
+    """Standard recipe with the bounded components sampled from the flaviolin bounds."""
+    df_stock, df_stand, df_bounds = flaviolin_fixture()
+    r = pd.DataFrame(np.random.default_rng(seed).random((n_designs, len(df_bounds))), columns=df_bounds.index)
+    df_targets = pd.DataFrame(np.tile(df_stand.loc[df_stock.index, 'Concentration'].values, (n_designs, 1)),
+                              columns=df_stock.index)
+    df_targets[df_bounds.index] = core.map_01_to_bounds(r, df_bounds, df_stand, fraction=0.5)
+    return df_targets
+
+
+def scaled_deck(copies: int) -> pd.DataFrame:
+    """The indigoidine deck repeated on `copies` sets of plates (src_plate_2, dest_plate_2, ...)."""
+    deck_df = mc.read_deckfile(indigoidine_deck)
+    frames = []
+    for i in range(copies):
+        frame = deck_df.copy()
+        if i:
+            plates = [f'{plate}_{i + 1}' for plate in frame.index.get_level_values('Plate')]
+            frame.index = pd.MultiIndex.from_arrays([plates, frame.index.get_level_values('Well')],
+                                                    names=frame.index.names)
+        frames.append(frame)
+    return pd.concat(frames)
+
+
+# Benchmarks
+
+def bench_find_volumes(n_designs, n_components):
+    def setup():
+        df_stock = synthetic_stocks(n_components)
+        targets = synthetic_targets(df_stock, n_designs).values / 10
+        return df_stock['High Concentration'].values, targets
+
+    def run(stock, targets):
+        for target in targets:
+            core.find_volumes(well_volume, stock_conc_val=stock, target_conc_val=target,
+                              culture_ratio=culture_ratio)
+
+    return Benchmark(f'find_volumes[designs={n_designs},components={n_components}]', setup, run, n_designs)
+
+
+def bench_find_volumes_bulk(n_designs, n_components, strategy='fallback'):
+    def setup():
+        df_stock = synthetic_stocks(n_components)
+        return df_stock, synthetic_targets(df_stock, n_designs)
+
+    def run(df_stock, df_targets):
+        core.find_volumes_bulk(df_stock, df_targets, well_volume=well_volume, min_tip_volume=min_tip_volume,
+                               culture_ratio=culture_ratio, strategy=strategy)
+
+    return Benchmark(f'find_volumes_bulk[{strategy},designs={n_designs},components={n_components}]',
+                     setup, run, n_designs)
+
+
+def bench_find_volumes_bulk_flaviolin(n_designs, strategy='fallback'):
+    def setup():
+        return flaviolin_fixture()[0], flaviolin_targets(n_designs)
+
+    def run(df_stock, df_targets):
+        core.find_volumes_bulk(df_stock, df_targets, well_volume=well_volume, min_tip_volume=min_tip_volume,
+                               culture_ratio=culture_ratio, strategy=strategy)
+
+    return Benchmark(f'find_volumes_bulk[{strategy},flaviolin,designs={n_designs}]', setup, run, n_designs)
+
+
+def bench_screen_designs(n_designs, backend='serial', workers=2):
+    def setup():
+        df_stock = synthetic_stocks(13)
+        return df_stock, synthetic_targets(df_stock, n_designs).values
+
+    def run(df_stock, targets):
+        core.screen_designs(df_stock, targets, well_volume=well_volume, min_tip_volume=min_tip_volume,
+                            culture_ratio=culture_ratio, workers=1 if backend == 'serial' else workers,
+                            shard_size=max(n_designs // (2 * workers), 1), processes=backend == 'process')
+
+    name = backend if backend == 'serial' else f'{backend},workers={workers}'
+    return Benchmark(f'screen_designs[{name},designs={n_designs}]', setup, run, n_designs)
+
+
+def bench_round_volume(n_designs, n_components):
+    def setup():
+        return (np.random.default_rng(0).uniform(0, well_volume, (n_designs, n_components)),)
+
+    def run(volumes):
+        core.round_volume(volumes, well_volume)
+
+    return Benchmark(f'round_volume[designs={n_designs},components={n_components}]',
+                     setup, run, n_designs * n_components)
+
+
+def bench_map_01_to_bounds(n_designs):
+    def setup():
+        df_stock, df_stand, df_bounds = flaviolin_fixture()
+        r = pd.DataFrame(np.random.default_rng(0).random((n_designs, len(df_bounds))), columns=df_bounds.index)
+        return r, df_bounds, df_stand
+
+    def run(r, df_bounds, df_stand):
+        core.map_01_to_bounds(r, df_bounds, df_stand, fraction=0.5)
+
+    return Benchmark(f'map_01_to_bounds[flaviolin,designs={n_designs}]', setup, run, n_designs)
+
+
+def bench_compile_media(copies, batch=False):
+    def setup():
+        return (scaled_deck(copies),)
+
+    def run(deck_df):
+        with tempfile.TemporaryDirectory() as path:
+            mc.compile_media(deck_df, batch=batch, output_dir=path)
+
+    n_wells = 45 * copies
+    mode = 'batch' if batch else 'sequential'
+    return Benchmark(f'compile_media[{mode},indigoidine,dest_wells={n_wells}]', setup, run, n_wells)
+
+
+def bench_generate_biomek_csvs(copies, reuse=None):
+    def setup():
+        with tempfile.TemporaryDirectory() as path:
+            biomek = mc.compile_media(scaled_deck(copies), output_dir=path)
+        return (biomek,)
+
+    def run(biomek):
+        with tempfile.TemporaryDirectory() as path:
+            schedule = biomek.schedule(reuse) if reuse is not None else None
+            mc.generate_biomek_csvs(biomek, output_dir=path, schedule=schedule)
+
+    n_wells = 45 * copies
+    return Benchmark(f'generate_biomek_csvs[reuse={reuse},indigoidine,dest_wells={n_wells}]',
+                     setup, run, n_wells)
+
+
+def suite(quick: bool=False):
+    """All benchmarks, with the largest sizes left out when `quick`."""
+
+    designs = [10, 1000, 10**5] if quick else [10, 1000, 10**5, 10**6]
+    components = [5, 13, 40]
+    copies = [1, 2] if quick else [1, 4, 8]
+
+    benchmarks = [bench_find_volumes(n, 13) for n in (10, 1000)]
+    benchmarks += [bench_find_volumes_bulk(n, 13, strategy) for strategy in ('fallback', 'optimal') for n in designs]
+    benchmarks += [bench_find_volumes_bulk(10**4, n) for n in components]
+    benchmarks += [bench_find_volumes_bulk_flaviolin(n, strategy) for strategy in ('fallback', 'optimal')
+                   for n in designs[1:]]
+    benchmarks += [bench_screen_designs(n, backend) for backend in ('serial', 'thread', 'process')
+                   for n in designs[1:]]
+    benchmarks += [bench_round_volume(n, 13) for n in designs]
+    benchmarks += [bench_map_01_to_bounds(n) for n in designs]
+    benchmarks += [bench_compile_media(n, batch) for batch in (False, True) for n in copies]
+    benchmarks += [bench_generate_biomek_csvs(n, reuse) for reuse in (None, 'water') for n in copies]
+    return benchmarks
+
+
+def measure(benchmark: Benchmark, repeat: int=3) -> Result:
+    """Best time over `repeat` runs and peak memory of one extra traced run.
+
+    Output of the benchmarked functions (e.g. the tip reports) is discarded."""
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        args = benchmark.setup()
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            benchmark.run(*args)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            benchmark.run(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    seconds = min(times)
+    return Result(benchmark.name, seconds, benchmark.items / seconds if seconds else float('inf'), peak / 2**20)
+
+
+def compare(results, baseline, threshold: float):
+    """Names of the benchmarks slower or heavier than in `baseline` by more than `threshold`."""
+    previous = {result['name']: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result.name)
+        if old is None:
+            continue
+        if result.seconds > threshold * old['seconds'] or result.peak_mb > threshold * max(old['peak_mb'], 1.):
+            regressions.append(result.name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='leave out the largest workloads')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed slowdown factor')
+    args = parser.parse_args(argv)
+
+    results = []
+    for benchmark in suite(args.quick):
+        if args.filter not in benchmark.name:
+            continue
+        result = measure(benchmark, repeat=args.repeat)
+        results.append(result)
+        print(f'{result.name:<70} {1e3 * result.seconds:>10.2f} ms {result.throughput:>14,.0f}/s '
+              f'{result.peak_mb:>9.1f} MB', flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump([result._asdict() for result in results], f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name in regressions:
+            print(f'Regression: {name}')
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,152 @@
-from enum import Enum
-from typing import List, Dict
+from enum import Enum, IntFlag
+from typing import List, Dict, NamedTuple
 from math import ceil, floor
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import re
 import string
+import sys
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from pyDOE import lhs
-import matplotlib.pyplot as plt
 
 
 pip_volume_threshold = 50  # threshold for using p300 above that volume
 mix_times: int = 3         # number of times for mixing
 rel_mix_volume = 0.75      # mixing volume, relative to the well volume
+EPS = 0.000001             # tolerance for the minimal tip volume checks
+
+
+class Tip(NamedTuple):
+    """A tip type and the head it is used on."""
+    head: str           # pipetting head, e.g. 'P20'
+    max_volume: float   # largest volume of a single transfer [uL]
+    use_below: float    # transfers below this volume go to this head, when it is available
+    min_volume: float = 5   # smallest volume pipetted reliably [uL]
+
+
+# Tips of the liquid handler; a new tip type is a new entry here
+tip_registry = {
+    'f20': Tip('P20', 36, 30),
+    's20': Tip('P20', 72, 30),
+    'f50': Tip('P50', 45, 45),
+    's50': Tip('P50', 81, 45),
+    'f200': Tip('P200', 190, np.inf),
+    's200': Tip('P200', 171, np.inf),
+}
+
+
+class Profiler(object):
+    """Stage timers and counters collected while `profiling` is active.
+
+    Timers are inclusive (a stage includes the stages it calls) and keyed by stage name;
+    every timed call is also kept as an event for `save_trace`.
+    """
+
+    def __init__(self):
+        self.timers = {}     # stage -> [calls, seconds]
+        self.counters = {}   # counter -> total
+        self.events = []     # (stage, start, duration) in seconds since the profiler was created
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            timer = self.timers.setdefault(name, [0, 0.])
+            timer[0] += 1
+            timer[1] += duration
+            self.events.append((name, start - self._start, duration))
+
+    def count(self, name: str, n: int=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self) -> pd.DataFrame:
+        """Calls and time of every stage, slowest first."""
+        df = pd.DataFrame([(name, calls, seconds) for name, (calls, seconds) in self.timers.items()],
+                          columns=['Stage', 'Calls', 'Seconds']).set_index('Stage')
+        df['Per Call [ms]'] = 1e3 * df['Seconds'] / df['Calls']
+        return df.sort_values('Seconds', ascending=False)
+
+    def to_dict(self) -> dict:
+        return {'timers': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in self.timers.items()},
+                'counters': dict(self.counters)}
+
+    def save_json(self, path: str):
+        """Save timers and counters as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def save_trace(self, path: str):
+        """Save all timed calls in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        events = [{'name': name, 'ph': 'X', 'ts': 1e6 * start, 'dur': 1e6 * duration, 'pid': 0, 'tid': 0}
+                  for name, start, duration in self.events]
+        end = max([event['ts'] + event['dur'] for event in events], default=0.)
+        events += [{'name': name, 'ph': 'C', 'ts': end, 'pid': 0, 'args': {name: value}}
+                   for name, value in self.counters.items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+
+# Active profiler, None unless inside `profiling`
+_profiler = None
+_no_stage = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def profiling(profiler: Profiler=None):
+    """Collect stage timers and counters of everything run inside the block.
+
+    Example::
+
+        with profiling() as profiler:
+            compile_media(deck_df)
+        profiler.report()
+        profiler.save_trace('compile_trace.json')
+
+    Outside the block instrumented code only checks that no profiler is active.
+    """
+
+    global _profiler
+    previous, _profiler = _profiler, Profiler() if profiler is None else profiler
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
+
+
+def profile_stage(name: str):
+    """Context manager timing the stage `name` when profiling, doing nothing otherwise."""
+    return _no_stage if _profiler is None else _profiler.stage(name)
+
+
+def profile_count(name: str, n: int=1):
+    """Add `n` to the counter `name` when profiling."""
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+def profiled(name: str):
+    """Decorator timing every call of a function as the stage `name` when profiling."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 def find_volumes(well_volume: float,
@@ -20,9 +156,15 @@ def find_volumes(well_volume: float,
                  stock_conc_val: np.ndarray=np.empty,
                  target_conc_val: np.ndarray=np.empty,
                  target_conf_df: pd.DataFrame=None,
-                 culture_ratio: int=100
+                 culture_ratio: int=100,
+                 cache=None
                  ):
-    """Find volumes for target concentrations given stock concentrations"""
+    """Find volumes for target concentrations given stock concentrations.
+
+    Solves a single design: `target_conc_file` only contributes its first row. Use
+    `find_volumes_stream` for every design of a target concentrations file.
+    With a `VolumeCache` as `cache`, a design solved before is not solved again.
+    """
     
     culture_volume = well_volume / culture_ratio
 
@@ -42,7 +184,6 @@ def find_volumes(well_volume: float,
     if stock_conc_val is not None:
         df["Stock Concentration"] = stock_conc_val
 
-    # TODO: Make it for the whole file
     if target_conc_file is not None:
         df_target_conc = pd.read_csv(target_conc_file, index_col=0)
         target_conc_val = df_target_conc.loc[0].values
@@ -50,50 +191,154 @@ def find_volumes(well_volume: float,
     elif target_conc_val is not None:
         df["Target Concentration"] = target_conc_val
     else:
-        print('Please provide target concentrations file or values.')
+        raise ValueError('Please provide target concentrations file or values.')
 
     target_conc_val = target_conc_val.ravel()
 
+    # Designs are only cached once they passed the checks below
+    if cache is not None:
+        key = cache.key(well_volume, culture_ratio, stock_conc_val, target_conc_val)
+        volumes = cache.lookup(key)
+        if volumes is not None:
+            df['Volumes[uL]'] = volumes[:-1]
+            return volumes.copy(), df
+
     # Check the conditions -  all target concentrations are <= stock; positivity;
     # sum of the ratios <= 1
-    assert (stock_conc_val >= 0).all(), "Not all stock concentrations are positive!"
-    assert (target_conc_val >= 0).all(), "Not all target concentrations are positive!"
-    assert (target_conc_val <= stock_conc_val).all(), "Not all target concentrations are <= " \
-                                                      "stock concentrations!"
-    assert well_volume >= 0, "Well volume is not positive!"
-    assert well_volume > culture_volume, "Well volume is not larger than culture volume!"
-    # TODO: Provide better message:
-    assert (np.sum([target_conc_val / stock_conc_val]) <= 1), "Requested target concentrations " \
-                                                              "cannot be achieved with provided " \
-                                                              "stock concentrations! "\
-                                                              " (Sum of the ratios is > 1!)"
-
-    solution_dim = len(target_conc_val)
-
-    # Create variables A, b for solving the system Ax=b
-    b = np.zeros(solution_dim + 1)
-
-    A = np.zeros((solution_dim + 1, solution_dim + 1))
-    for i in range(solution_dim):
-        A[i, :] = target_conc_val[i] / stock_conc_val[i]
-        A[i, i] -= 1
-        b[i] = target_conc_val[i] / stock_conc_val[i]
-
-    A[-1, :] = np.ones(solution_dim + 1)
-    b[-1] = 1 - (well_volume/culture_volume)
-    b = -1.0 * culture_volume * b
-
-    volumes = np.linalg.solve(A, b)
-
-    assert (volumes >= 0).all(), "Not all volumes in the solution are positive!"
-    assert (abs(np.sum(volumes) + culture_volume - well_volume) < 0.1), "Sum of volumes from the solution is " \
-                                                       "not equal to the total well volume!"
+    if not (stock_conc_val >= 0).all():
+        raise ValueError("Not all stock concentrations are positive!")
+    if not well_volume >= 0:
+        raise ValueError("Well volume is not positive!")
+    if not well_volume > culture_volume:
+        raise ValueError("Well volume is not larger than culture volume!")
+
+    status = design_status(stock_conc_val, target_conc_val, well_volume,
+                           culture_ratio=culture_ratio)[0]
+    if status:
+        raise InfeasibleVolumesError(int(status))
+
+    volumes = find_volumes_batch(well_volume,
+                                 stock_conc_val,
+                                 target_conc_val,
+                                 culture_ratio=culture_ratio)[0]
+    if cache is not None:
+        cache.store(key, volumes.copy())
 
     df['Volumes[uL]'] = volumes[:-1]
 
     return volumes, df
 
 
+def find_volumes_batch(well_volume: float,
+                       stock_conc_val: np.ndarray,
+                       target_conc_val: np.ndarray,
+                       culture_ratio: int=100
+                       ) -> np.ndarray:
+    """Find volumes for a whole batch of target concentrations in one pass.
+
+    The system solved in `find_volumes` is diagonal plus rank-one with a row of ones,
+    so it has a closed form: every component takes `well_volume * target / stock` and
+    water fills what is left of the well after the culture. No validation is done here,
+    infeasible designs show up as negative water volumes.
+
+    :param well_volume: Total volume of the well (media and culture).
+    :type well_volume: float
+    :param stock_conc_val: Stock concentrations, either one vector of shape (n,) shared by
+        all designs or a matrix of shape (N, n) with stocks for each design.
+    :type stock_conc_val: numpy array
+    :param target_conc_val: Target concentrations of shape (N, n), or (n,) for one design.
+    :type target_conc_val: numpy array
+    :param culture_ratio: Dilution factor for the culture.
+    :type culture_ratio: int
+    :return: Volumes of shape (N, n+1), with water volumes in the last column.
+    """
+
+    culture_volume = well_volume / culture_ratio
+
+    target_conc_val = np.atleast_2d(np.asarray(target_conc_val, dtype=float))
+    stock_conc_val = np.asarray(stock_conc_val, dtype=float)
+
+    n_samples, solution_dim = target_conc_val.shape
+    volumes = np.empty((n_samples, solution_dim + 1))
+
+    comp_volumes = volumes[:, :-1]
+    np.divide(target_conc_val, stock_conc_val, out=comp_volumes)
+    comp_volumes *= well_volume
+    volumes[:, -1] = well_volume - culture_volume - comp_volumes.sum(axis=1)
+
+    return volumes
+
+
+class CacheInfo(NamedTuple):
+    """Statistics of a `VolumeCache`."""
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class VolumeCache(object):
+    """Bounded cache of solved designs, evicting the least recently used one.
+
+    Keys are built from the well volume, culture ratio and the stock and target vectors;
+    the vectors are quantized to `bits` significant mantissa bits first, so concentrations
+    differing only by floating point noise share an entry.
+
+    :param maxsize: Largest number of entries kept.
+    :type maxsize: int
+    :param bits: Significant bits kept of every concentration in a key.
+    :type bits: int
+    """
+
+    def __init__(self, maxsize: int=1024, bits: int=40):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.bits = bits
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def quantize(self, values) -> np.ndarray:
+        """Round `values` to `bits` significant bits."""
+        mantissa, exponent = np.frexp(np.asarray(values, dtype=float))
+        return np.ldexp(np.rint(np.ldexp(mantissa, self.bits)), exponent - self.bits)
+
+    def key(self, *parts) -> tuple:
+        """Hashable key of `parts`, with arrays quantized."""
+        return tuple(self.quantize(part).tobytes() if isinstance(part, (np.ndarray, list)) else part
+                     for part in parts)
+
+    def lookup(self, key):
+        """Cached value of `key`, or None; counts a hit or a miss."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def store(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used entry when full."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def clear(self):
+        """Drop all entries and reset the statistics."""
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
 def check_solubility(df, solubility, verbose=True):    
     
     components = list(df[df["Stock Concentration"] > solubility].index)
@@ -107,122 +352,1011 @@ def check_solubility(df, solubility, verbose=True):
     return components
 
 
+class BulkVolumes(NamedTuple):
+    """Volumes for a batch of designs together with the stock levels used."""
+    volumes: np.ndarray   # (N, n+1) volumes, water in the last column
+    low: np.ndarray       # (N, n) True where the low stock concentration is used
+    feasible: np.ndarray  # (N,) True where all volumes can be pipetted
+
+
+def _solve_valid(well_volume, stock_conc_val, target_conc_val, culture_ratio):
+    """Batched solve plus the checks `find_volumes` asserts on, as a per-row mask."""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        volumes = find_volumes_batch(well_volume, stock_conc_val, target_conc_val,
+                                     culture_ratio=culture_ratio)
+    valid = ((target_conc_val >= 0) & (target_conc_val <= stock_conc_val)).all(axis=1)
+    valid &= (volumes >= 0).all(axis=1)
+
+    return volumes, valid
+
+
+def find_volumes_levels(stock_high: np.ndarray,
+                        stock_low: np.ndarray,
+                        target_conc_val: np.ndarray,
+                        well_volume: float,
+                        min_tip_volume: float,
+                        culture_ratio: int=100
+                        ) -> BulkVolumes:
+    """Find volumes for all designs, choosing between high and low stocks.
+
+    Same fallback as `find_volumes_bulk` always had, on whole arrays: all designs are solved
+    with high stocks, components below `min_tip_volume` are switched to low stocks and only
+    those rows are solved again, and rows that still fail are solved with low stocks only.
+
+    :param stock_high: High stock concentrations, shape (n,).
+    :param stock_low: Low stock concentrations, shape (n,).
+    :param target_conc_val: Target concentrations, shape (N, n).
+    :param well_volume: Total volume of the well (media and culture).
+    :param min_tip_volume: Minimal transfer volume of the liquid handler.
+    :param culture_ratio: Dilution factor for the culture.
+    :return: BulkVolumes with volumes (N, n+1), low stock mask (N, n) and feasibility (N,).
+    """
+
+    stock_high = np.asarray(stock_high, dtype=float)
+    stock_low = np.asarray(stock_low, dtype=float)
+    target_conc_val = np.atleast_2d(np.asarray(target_conc_val, dtype=float))
+    min_volume = min_tip_volume - EPS
+
+    # All high
+    volumes, valid = _solve_valid(well_volume, stock_high, target_conc_val, culture_ratio)
+    small = volumes[:, :-1] < min_volume
+    feasible = valid & ~small.any(axis=1)
+
+    # High, with low stocks for components below the minimal tip volume
+    retry = np.flatnonzero(valid & ~feasible)
+    low = np.zeros(target_conc_val.shape, dtype=bool)
+    profile_count('fallbacks_mixed_stocks', len(retry))
+    if len(retry):
+        stock_mixed = np.where(small[retry], stock_low, stock_high)
+        vol_mixed, valid_mixed = _solve_valid(well_volume, stock_mixed,
+                                              target_conc_val[retry], culture_ratio)
+        solved = retry[valid_mixed]
+        volumes[solved] = vol_mixed[valid_mixed]
+        low[solved] = small[solved]
+        feasible[retry] = valid_mixed & (vol_mixed[:, :-1] >= min_volume).all(axis=1)
+
+    # All low
+    retry = np.flatnonzero(~feasible)
+    profile_count('fallbacks_low_stocks', len(retry))
+    if len(retry):
+        vol_low, valid_low = _solve_valid(well_volume, stock_low,
+                                          target_conc_val[retry], culture_ratio)
+        # Infeasible rows keep the last solution that passed the checks
+        keep = valid_low | ~valid[retry]
+        volumes[retry[keep]] = vol_low[keep]
+        low[retry[keep]] = True
+        feasible[retry] = valid_low & (vol_low[:, :-1] >= min_volume).all(axis=1)
+
+    return BulkVolumes(volumes, low, feasible)
+
+
+class StockLevels(NamedTuple):
+    """Volumes for a batch of designs together with the stock level of every component."""
+    volumes: np.ndarray   # (N, n+1) volumes, water in the last column
+    level: np.ndarray     # (N, n) index of the stock level used, -1 where none fits
+    feasible: np.ndarray  # (N,) True where all volumes can be pipetted
+
+
+def assign_stock_levels(stock_levels: np.ndarray,
+                        target_conc_val: np.ndarray,
+                        well_volume: float,
+                        min_tip_volume: float,
+                        culture_ratio: int=100,
+                        max_component_volume: float=None,
+                        min_water_volume: float=0.
+                        ) -> StockLevels:
+    """Find the best stock level for every component of every design.
+
+    Components only interact through the water volume, which is whatever is left of the
+    well after the culture and all component volumes. The search over all level combinations
+    therefore reduces to a choice per component: the most concentrated stock that still gives
+    a volume of at least `min_tip_volume` (and at most `max_component_volume`). That choice
+    gives every component its smallest possible volume at once, hence the most water headroom
+    and the fewest transfers, and a design is feasible exactly when the water left over is at
+    least `min_water_volume`.
+
+    :param stock_levels: Stock concentrations of shape (L, n), one row per level.
+    :param target_conc_val: Target concentrations of shape (N, n).
+    :param well_volume: Total volume of the well (media and culture).
+    :param min_tip_volume: Minimal transfer volume of the liquid handler.
+    :param culture_ratio: Dilution factor for the culture.
+    :param max_component_volume: Optional upper bound for the volume of one component.
+    :param min_water_volume: Minimal water volume needed in the well.
+    :return: StockLevels with volumes (N, n+1), levels (N, n) and feasibility (N,).
+        Components without a usable level get a NaN volume and level -1.
+    """
+
+    stock_levels = np.atleast_2d(np.asarray(stock_levels, dtype=float))
+    target_conc_val = np.atleast_2d(np.asarray(target_conc_val, dtype=float))
+    culture_volume = well_volume / culture_ratio
+
+    comp_volumes = np.full(target_conc_val.shape, np.inf)
+    level = np.full(target_conc_val.shape, -1)
+
+    for i, stock in enumerate(stock_levels):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vol = well_volume * target_conc_val / stock
+        usable = (target_conc_val <= stock) & (vol >= min_tip_volume - EPS)
+        if max_component_volume is not None:
+            usable &= vol <= max_component_volume + EPS
+        better = usable & (vol < comp_volumes)
+        comp_volumes[better] = vol[better]
+        level[better] = i
+
+    comp_volumes[level < 0] = np.nan
+
+    volumes = np.empty((len(target_conc_val), target_conc_val.shape[1] + 1))
+    volumes[:, :-1] = comp_volumes
+    volumes[:, -1] = well_volume - culture_volume - comp_volumes.sum(axis=1)
+
+    feasible = (level >= 0).all(axis=1) & (volumes[:, -1] >= min_water_volume - EPS)
+
+    return StockLevels(volumes, level, feasible)
+
+
+class FeasibilityIndex(NamedTuple):
+    """Feasibility constraints of one stock configuration, precomputed by `feasibility_index`.
+
+    A design is feasible when every component has a usable level (its target lies between
+    `min_target` and the stock) and the volumes of the most concentrated usable levels, a dot
+    product of the targets with `volume_per_target`, fit in `max_volume`. This is the same
+    check as `assign_stock_levels` (and `find_volumes_levels` for high and low stocks),
+    without solving for the volumes.
+    """
+    components: np.ndarray         # (n,) component names
+    level_names: np.ndarray        # (L,) stock level names
+    stock_levels: np.ndarray       # (L, n) stock concentrations, NaN where a level is missing
+    min_target: np.ndarray         # (L, n) smallest target giving at least the minimal tip volume
+    volume_per_target: np.ndarray  # (L, n) well_volume / stock
+    order: np.ndarray              # (L, n) levels of each component, most concentrated first
+    max_volume: float              # volume left for the components: well minus culture and water
+
+    def level(self, target_conc_val: np.ndarray) -> np.ndarray:
+        """Index of the level used by every component of every design, -1 where none fits."""
+
+        target_conc_val = np.atleast_2d(np.asarray(target_conc_val, dtype=float))
+        columns = np.arange(len(self.components))
+        level = np.full(target_conc_val.shape, -1)
+        for levels in self.order[::-1]:
+            usable = ((target_conc_val >= self.min_target[levels, columns]) &
+                      (target_conc_val <= self.stock_levels[levels, columns]))
+            level = np.where(usable, levels, level)
+        return level
+
+    def check(self, target_conc_val: np.ndarray) -> np.ndarray:
+        """True for the designs that can be pipetted, shape (N,)."""
+
+        target_conc_val = np.atleast_2d(np.asarray(target_conc_val, dtype=float))
+        level = self.level(target_conc_val)
+        columns = np.arange(len(self.components))
+        volume = np.einsum('ij,ij->i', target_conc_val, self.volume_per_target[level, columns])
+        return (level >= 0).all(axis=1) & (volume <= self.max_volume)
+
+    def save(self, path: str):
+        """Write the index to an `.npz` file."""
+        np.savez(path, **self._asdict())
+
+    @classmethod
+    def load(cls, path: str):
+        """Read an index written by `save`."""
+        with np.load(path) as data:
+            return cls(**{field: data[field] for field in cls._fields})._replace(
+                max_volume=float(data['max_volume']))
+
+
+def feasibility_index(df_stock: pd.DataFrame,
+                      well_volume: float,
+                      min_tip_volume: float,
+                      culture_ratio: int=100,
+                      levels: dict=None,
+                      plates: dict=None,
+                      min_water_volume: float=0.) -> FeasibilityIndex:
+    """Precompute the feasibility constraints of a stock configuration.
+
+    :param df_stock: Stock concentrations, indexed by component.
+    :param well_volume: Total volume of the well (media and culture).
+    :param min_tip_volume: Minimal transfer volume of the liquid handler.
+    :param culture_ratio: Dilution factor for the culture.
+    :param levels: Dict of level name to `df_stock` column, high and low by default.
+    :param plates: Optional dict of level name to stock plate layout (with a 'Component'
+        column, e.g. `24-well_stock_plate_high.csv`); a component that is on some of the
+        plates can not use the levels whose plate it is missing from.
+    :param min_water_volume: Minimal water volume needed in the well.
+    :return: FeasibilityIndex, whose `check` validates designs with a few array operations.
+    """
+
+    if levels is None:
+        levels = {'high': 'High Concentration', 'low': 'Low Concentration'}
+
+    stock_levels = df_stock[list(levels.values())].values.T.astype(float)
+    if plates is not None:
+        on_plates = df_stock.index.isin(pd.concat([plate['Component'] for plate in plates.values()]))
+        for i, name in enumerate(levels):
+            if name in plates:
+                stock_levels[i, on_plates & ~df_stock.index.isin(plates[name]['Component'])] = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        volume_per_target = well_volume / stock_levels
+    order = np.argsort(np.where(np.isnan(stock_levels), -np.inf, -stock_levels), axis=0, kind='stable')
+
+    return FeasibilityIndex(components=np.array(df_stock.index, dtype=str),
+                            level_names=np.array(list(levels), dtype=str),
+                            stock_levels=stock_levels,
+                            min_target=(min_tip_volume - EPS) * stock_levels / well_volume,
+                            volume_per_target=volume_per_target,
+                            order=order,
+                            max_volume=well_volume - well_volume / culture_ratio - min_water_volume + EPS)
+
+
+class Infeasible(IntFlag):
+    """Reasons a design cannot be made, combined as bit flags; 0 means feasible."""
+    NEGATIVE_TARGET = 1  # a target concentration is negative
+    EXCEEDS_STOCK = 2    # a target is above the highest stock concentration of its component
+    RATIO_SUM = 4        # the components overfill the well even with the most concentrated stocks
+    NEGATIVE_VOLUME = 8  # a volume of the solution is negative (no room left for water or the culture)
+    BELOW_MIN_TIP = 16   # a component volume is below the minimal tip volume
+
+
+reason_messages = {
+    Infeasible.NEGATIVE_TARGET: 'Not all target concentrations are positive!',
+    Infeasible.EXCEEDS_STOCK: 'Not all target concentrations are <= the highest stock concentrations!',
+    Infeasible.RATIO_SUM: 'Requested target concentrations cannot be achieved with provided '
+                          'stock concentrations! (Sum of the ratios is > 1!)',
+    Infeasible.NEGATIVE_VOLUME: 'Not all volumes in the solution are positive!',
+    Infeasible.BELOW_MIN_TIP: 'Not all volumes are above the minimal tip volume!',
+}
+
+
+def design_status(stock_levels: np.ndarray,
+                  target_conc_val: np.ndarray,
+                  well_volume: float,
+                  min_tip_volume: float=None,
+                  culture_ratio: int=100,
+                  volumes: np.ndarray=None
+                  ) -> np.ndarray:
+    """Reason codes (`Infeasible` flags) of every design.
+
+    `EXCEEDS_STOCK` and `RATIO_SUM` are checked against the most concentrated stocks, so no
+    choice of stocks can avoid them. `NEGATIVE_VOLUME` and `BELOW_MIN_TIP` are checked on
+    `volumes`, the solution of a solver (e.g. `find_volumes_levels`), or on the volumes with
+    the most concentrated stocks if none is given; `BELOW_MIN_TIP` is then only set when
+    even the least concentrated stocks give a volume below the minimal tip volume.
+
+    :param stock_levels: Stock concentrations, shape (n,) or (L, n) with one row per level.
+    :param target_conc_val: Target concentrations, shape (N, n) or (n,) for one design.
+    :param min_tip_volume: Minimal transfer volume, None to skip the tip check.
+    :param volumes: Optional solved volumes (N, n+1), water in the last column.
+    :return: Integer array (N,) of combined `Infeasible` flags.
+    """
+
+    stock_levels = np.atleast_2d(np.asarray(stock_levels, dtype=float))
+    target_conc_val = np.atleast_2d(np.asarray(target_conc_val, dtype=float))
+    stock_max = stock_levels.max(axis=0)
+    status = np.zeros(len(target_conc_val), dtype=int)
+
+    status[(target_conc_val < 0).any(axis=1)] |= Infeasible.NEGATIVE_TARGET
+    status[(target_conc_val > stock_max).any(axis=1)] |= Infeasible.EXCEEDS_STOCK
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio_sum = (target_conc_val / stock_max).sum(axis=1)
+    status[ratio_sum > 1] |= Infeasible.RATIO_SUM
+
+    solved = volumes is not None
+    if not solved:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volumes = find_volumes_batch(well_volume, stock_max, target_conc_val, culture_ratio=culture_ratio)
+    volumes = np.atleast_2d(np.asarray(volumes, dtype=float))
+    status[(volumes < 0).any(axis=1)] |= Infeasible.NEGATIVE_VOLUME
+
+    if min_tip_volume is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            largest = well_volume * target_conc_val / stock_levels.min(axis=0)
+        below = (largest < min_tip_volume - EPS).any(axis=1)
+        if solved:
+            below |= (volumes[:, :-1] < min_tip_volume - EPS).any(axis=1)
+        status[below] |= Infeasible.BELOW_MIN_TIP
+
+    return status
+
+
+class VolumeResult(NamedTuple):
+    """Volumes of a batch of designs with the status of every design."""
+    volumes: pd.DataFrame      # volumes, water in the last column
+    conc_level: pd.DataFrame   # stock level of every component
+    status: pd.Series          # combined `Infeasible` flags, 0 for feasible designs
+
+    @property
+    def feasible(self) -> pd.Series:
+        return self.status == 0
+
+    def reasons(self) -> pd.Series:
+        """Number of designs failing for every reason (a design can fail for several)."""
+        return pd.Series({reason.name: int((self.status.values & reason).astype(bool).sum())
+                          for reason in Infeasible})
+
+
+def _solve_bulk(df_stock, target_conc_val, well_volume, min_tip_volume, culture_ratio, strategy, levels):
+    """Volumes, stock level names and feasibility of `find_volumes_bulk`, as arrays."""
+
+    profile_count('solves', len(target_conc_val))
+    if strategy == 'fallback':
+        result = find_volumes_levels(df_stock['High Concentration'].values,
+                                     df_stock['Low Concentration'].values,
+                                     target_conc_val,
+                                     well_volume=well_volume,
+                                     min_tip_volume=min_tip_volume,
+                                     culture_ratio=culture_ratio)
+        volumes, feasible = result.volumes, result.feasible
+        conc_level = np.where(result.low, 'low', 'high')
+
+    elif strategy == 'optimal':
+        if levels is None:
+            levels = {'high': 'High Concentration', 'low': 'Low Concentration'}
+        result = assign_stock_levels(df_stock[list(levels.values())].values.T,
+                                     target_conc_val,
+                                     well_volume=well_volume,
+                                     min_tip_volume=min_tip_volume,
+                                     culture_ratio=culture_ratio)
+        volumes, feasible = result.volumes, result.feasible
+        level_names = np.array(list(levels) + [None], dtype=object)
+        conc_level = level_names[result.level]
+
+    else:
+        raise ValueError(f'Unknown strategy: {strategy}')
+
+    return volumes, conc_level, feasible
+
+
+@profiled('find_volumes_bulk')
 def find_volumes_bulk(df_stock,  
                  df_target_conc=None,
                  well_volume=None,
                  min_tip_volume=None,
                  culture_ratio=None,
-                 verbose=0):
-    
-    EPS = 0.000001
-    
-    df_volumes = df_target_conc.copy()
-    df_volumes['Water'] = None
-    
-    df_conc_level = pd.DataFrame(data='high',
+                 verbose=0,
+                 return_feasible=False,
+                 strategy='fallback',
+                 levels=None,
+                 return_result=False):
+    """Find volumes for all designs in `df_target_conc`.
+
+    With `strategy='fallback'` stocks are chosen as in `find_volumes_levels`, with
+    `strategy='optimal'` every component gets the best of the stock levels in `levels`,
+    a dict of level name to `df_stock` column (high and low by default), as in
+    `assign_stock_levels`.
+
+    Returns volumes (with a 'Water' column) and the stock level of every component;
+    with `return_feasible` also a boolean Series marking the feasible designs. With
+    `return_result` a `VolumeResult` is returned instead, with the reason codes of every
+    design; infeasible designs are reported there, never raised.
+    """
+
+    volumes, conc_level, feasible = _solve_bulk(df_stock, df_target_conc.values, well_volume, min_tip_volume,
+                                                culture_ratio, strategy, levels)
+
+    df_volumes = pd.DataFrame(data=volumes,
+                              index=df_target_conc.index,
+                              columns=list(df_target_conc.columns) + ['Water'])
+
+    df_conc_level = pd.DataFrame(data=conc_level,
                                  index=df_target_conc.index,
                                  columns=df_target_conc.columns)
-        
-    target_conc_val = df_target_conc.values
-    
-    success_num = 0
-    success_wat_num = 0
-    
-    n_samples = len(df_target_conc)
 
-    for i in range(n_samples):
-        if verbose >= 1:
-            print(f'Iteration {i}:')
-        success = False
+    feasible = pd.Series(feasible, index=df_target_conc.index)
+
+    if verbose >= 1:
+        n_samples = max(len(feasible), 1)
+        success_wat_num = np.sum(feasible.values & (volumes[:, -1] > 20))
+        print(f'Sucess rate: {100*feasible.sum()/n_samples}%')
+        print(f'Sucess rate (water): {100*success_wat_num/n_samples}%')
+
+    if return_result:
+        if levels is None:
+            levels = {'high': 'High Concentration', 'low': 'Low Concentration'}
+        status = design_status(df_stock[list(levels.values())].values.T,
+                               df_target_conc.values,
+                               well_volume=well_volume,
+                               min_tip_volume=min_tip_volume,
+                               culture_ratio=culture_ratio,
+                               volumes=volumes)
+        return VolumeResult(df_volumes, df_conc_level, pd.Series(status, index=df_target_conc.index))
+
+    if return_feasible:
+        return df_volumes, df_conc_level, feasible
 
-        try:
-            volumes, df_example = find_volumes(
-                well_volume,
-                components=df_stock.index,
-                stock_conc_val=df_stock['High Concentration'].values, 
-                target_conc_val=target_conc_val[i],
-                culture_ratio=culture_ratio)
-            if not (df_example['Volumes[uL]'] >= min_tip_volume - EPS).all():
-                if verbose > 1:
-                    print(f'High: Not all volumes are >={min_tip_volume} uL!')
-
-                # Find volumes smaller than min transfer volume
-                comp_small_vol = df_example[df_example['Volumes[uL]'] < min_tip_volume - EPS].index 
-                if verbose:
-                    print(f'Compoments small: {comp_small_vol}')
-                
-                # Assign low concentrations for those components
-                for comp in comp_small_vol:
-                    df_example.at[comp, 'Stock Concentration'] = df_stock.at[comp,'Low Concentration']
-                    df_conc_level.iloc[i][comp] = 'low'
-
-                # Recalculate  volumes
-                volumes, df_example_new = find_volumes(
-                    well_volume, 
-                    components=df_stock.index,
-                    stock_conc_val=df_example['Stock Concentration'].values, 
-                    target_conc_val=target_conc_val[i],
-                    culture_ratio=culture_ratio)
-                
-                if not (df_example_new['Volumes[uL]'] >= min_tip_volume - EPS).all():
-                    if verbose >= 1:
-                        print(f'High + Low min vol: Not all volumes are >={min_tip_volume} uL!')
-                else:
-                    if verbose > 1:
-                        print('Success High + Low min vol')
-                    success_num += 1
-                    success = True
-                    water_vol = volumes[-1]
-                    if water_vol > 20:
-                        success_wat_num += 1
-
-            else:
-                if verbose > 1:
-                    print("Success High")
-                success_num += 1
-                success = True
-                water_vol = volumes[-1]
-                if water_vol > 20:
-                    success_wat_num += 1
-
-        except:
-            if verbose >= 1:
-                print('Failed High + Low min vol')
-            pass
-
-        if not success:
-            try:
-                volumes, df_example = find_volumes(
-                    well_volume, 
-                    components=df_stock.index,
-                    stock_conc_val=df_stock['Low Concentration'].values, 
-                    target_conc_val=target_conc_val[i],
-                    culture_ratio=culture_ratio)
-
-                if not (df_example['Volumes[uL]'] >= min_tip_volume - EPS).all():
-                    if verbose >= 1:
-                        print(f'Low: Not all volumes are >={min_tip_volume} uL!')
-                else:
-                    if verbose > 1:
-                        print('Success Low')
-                    success_num += 1
-                    water_vol = volumes[-1]
-                    if water_vol > 20:
-                        success_wat_num += 1
-
-            except:
-                if verbose >= 1:
-                    print('Failed Low')
-                pass
-        
-        df_volumes.iloc[i] = list(volumes)
-    
-    print(f'Sucess rate: {100*success_num/n_samples}%')
-    print(f'Sucess rate (water): {100*success_wat_num/n_samples}%')
-    
     return df_volumes, df_conc_level
     
 
+def well_fingerprints(df_stock: pd.DataFrame,
+                      df_target_conc: pd.DataFrame,
+                      well_volume: float,
+                      min_tip_volume: float,
+                      culture_ratio: int=100,
+                      tips=('f20', 'f200'),
+                      strategy: str='fallback',
+                      levels: dict=None) -> pd.Series:
+    """Fingerprint of everything the volumes of a destination well depend on.
+
+    Hashes the target row of every well together with the stocks, well volume, tip set and
+    solver settings shared by all wells, so two runs give a well the same fingerprint exactly
+    when its volumes and transfers come out the same.
+
+    :return: Hex digests indexed like `df_target_conc`.
+    """
+
+    columns = ['High Concentration', 'Low Concentration'] if levels is None else list(levels.values())
+    shared = hashlib.sha1(repr((list(df_target_conc.columns), list(df_stock.index), str(levels), strategy,
+                                float(well_volume), float(min_tip_volume), float(culture_ratio),
+                                list(tips))).encode())
+    shared.update(np.ascontiguousarray(df_stock[columns].values, dtype=float).tobytes())
+
+    fingerprints = []
+    for row in np.ascontiguousarray(df_target_conc.values, dtype=float):
+        digest = shared.copy()
+        digest.update(row.tobytes())
+        fingerprints.append(digest.hexdigest())
+
+    return pd.Series(fingerprints, index=df_target_conc.index, name='Fingerprint')
+
+
+class IncrementalVolumes(NamedTuple):
+    """Volumes of all wells, of which only the `changed` wells were solved again."""
+    volumes: pd.DataFrame
+    conc_level: pd.DataFrame
+    feasible: pd.Series
+    fingerprints: pd.Series
+    changed: pd.Index   # wells that are new or whose fingerprint changed
+    removed: pd.Index   # wells of the previous run that are gone
+
+
+def find_volumes_incremental(df_stock: pd.DataFrame,
+                             df_target_conc: pd.DataFrame,
+                             state_file: str,
+                             well_volume: float,
+                             min_tip_volume: float,
+                             culture_ratio: int=100,
+                             tips=('f20', 'f200'),
+                             strategy: str='fallback',
+                             levels: dict=None) -> IncrementalVolumes:
+    """`find_volumes_bulk` that only solves the wells changed since the last run.
+
+    Volumes, stock levels and fingerprints (`well_fingerprints`) of the previous run are kept
+    in `state_file`; wells with the same fingerprint reuse their volumes, the others are solved
+    again and the state is updated. Without a state file all wells are solved.
+
+    :param state_file: Pickle file holding the state between runs, e.g. in the cycle output folder.
+    :return: IncrementalVolumes for all wells of `df_target_conc`, in its order.
+    """
+
+    fingerprints = well_fingerprints(df_stock, df_target_conc, well_volume, min_tip_volume,
+                                     culture_ratio=culture_ratio, tips=tips, strategy=strategy, levels=levels)
+
+    previous = pd.read_pickle(state_file) if os.path.exists(state_file) else None
+    if previous is None:
+        same = np.zeros(len(fingerprints), dtype=bool)
+        removed = pd.Index([])
+    else:
+        same = (fingerprints == previous['fingerprints'].reindex(fingerprints.index)).values
+        removed = previous['fingerprints'].index.difference(fingerprints.index)
+    changed = fingerprints.index[~same]
+
+    df_volumes, df_conc_level, feasible = find_volumes_bulk(df_stock,
+                                                            df_target_conc=df_target_conc.loc[changed],
+                                                            well_volume=well_volume,
+                                                            min_tip_volume=min_tip_volume,
+                                                            culture_ratio=culture_ratio,
+                                                            return_feasible=True,
+                                                            strategy=strategy,
+                                                            levels=levels)
+    if previous is not None and same.any():
+        kept = fingerprints.index[same]
+        df_volumes = pd.concat([previous['volumes'].loc[kept], df_volumes]).loc[fingerprints.index]
+        df_conc_level = pd.concat([previous['conc_level'].loc[kept], df_conc_level]).loc[fingerprints.index]
+        feasible = pd.concat([previous['feasible'].loc[kept], feasible]).loc[fingerprints.index]
+
+    pd.to_pickle({'fingerprints': fingerprints, 'volumes': df_volumes,
+                  'conc_level': df_conc_level, 'feasible': feasible}, state_file)
+
+    return IncrementalVolumes(df_volumes, df_conc_level, feasible, fingerprints, changed, removed)
+
+
+def write_csv_if_changed(df: pd.DataFrame, path: str, **kwargs) -> bool:
+    """Write `df` to `path` (with `DataFrame.to_csv` options) unless the file already holds it.
+
+    :return: True if the file was written.
+    """
+
+    text = df.to_csv(**kwargs)
+    if os.path.exists(path):
+        with open(path, newline='') as f:
+            if f.read() == text:
+                return False
+    with open(path, 'w', newline='') as f:
+        f.write(text)
+    return True
+
+
+def strip_unit(name: str) -> str:
+    """Component name without a unit suffix, e.g. 'MOPS[mM]' -> 'MOPS'."""
+    return re.sub(r'\[.*\]$', '', str(name)).strip()
+
+
+def read_stock_concentrations(stock_conc_file: str) -> pd.DataFrame:
+    """Stock concentrations file (`stock_concentrations.csv`) indexed by component.
+
+    Fold stocks written like '300x' (antibiotics) are read as their factor.
+
+    :raises ValueError: If a stock concentration is not a number.
+    """
+
+    df_stock = pd.read_csv(stock_conc_file, index_col=0)
+    columns = ['Low Concentration', 'High Concentration']
+    df_stock[columns] = df_stock[columns].replace(r'x$', '', regex=True).apply(pd.to_numeric, errors='coerce')
+    invalid = df_stock.index[df_stock[columns].isna().any(axis=1)]
+    if len(invalid):
+        raise ValueError(f'Stock concentrations are not numbers for: {", ".join(map(str, invalid))}')
+    return df_stock
+
+
+def find_volumes_stream(df_stock: pd.DataFrame,
+                        target_conc_file: str,
+                        volumes_file: str,
+                        conc_level_file: str,
+                        feasible_file: str=None,
+                        well_volume: float=None,
+                        min_tip_volume: float=None,
+                        culture_ratio: int=100,
+                        fixed: pd.Series=None,
+                        chunksize: int=10000,
+                        strategy: str='fallback',
+                        levels: dict=None):
+    """Find volumes for every design of a target concentrations file, one chunk at a time.
+
+    Reads `target_conc_file` (designs indexed by the first column) in chunks of `chunksize`
+    rows, solves each chunk with `find_volumes_bulk` and appends volumes, stock levels and
+    feasibility to the output files, so memory stays bounded by the chunk size.
+
+    :param df_stock: Stock concentrations, as for `find_volumes_bulk`.
+    :param target_conc_file: CSV file of target concentrations, one design per row.
+    :param volumes_file: Output CSV file for the volumes.
+    :param conc_level_file: Output CSV file for the stock levels.
+    :param feasible_file: Optional output CSV file marking the feasible designs, with the
+        `Infeasible` reason codes of every design.
+    :param fixed: Concentrations of components kept constant, for components that are
+        not in the target file (e.g. from the standard recipe).
+        Component names are matched to `df_stock` without unit suffixes ('MOPS' is 'MOPS[mM]').
+    :param chunksize: Number of designs solved at once.
+    :return: Number of designs and number of feasible designs.
+    :raises ValueError: If a stock component is neither in the targets nor in `fixed`.
+    """
+
+    # Targets and fixed concentrations are matched to the stocks without unit suffixes
+    names = {strip_unit(comp): comp for comp in df_stock.index}
+    if fixed is not None:
+        fixed = fixed.rename(index=lambda comp: names.get(strip_unit(comp), comp))
+
+    n_designs, n_feasible = 0, 0
+    for chunk in pd.read_csv(target_conc_file, index_col=0, chunksize=chunksize):
+        chunk = chunk.rename(columns=lambda column: names.get(strip_unit(column), column))
+        if fixed is not None:
+            for comp in fixed.index.drop(chunk.columns, errors='ignore'):
+                chunk[comp] = fixed[comp]
+        missing = df_stock.index.drop(chunk.columns, errors='ignore')
+        if len(missing):
+            raise ValueError(f'Components missing from the targets and the fixed concentrations: '
+                             f'{", ".join(map(str, missing))}')
+        chunk = chunk[df_stock.index]
+
+        result = find_volumes_bulk(df_stock,
+                                   df_target_conc=chunk,
+                                   well_volume=well_volume,
+                                   min_tip_volume=min_tip_volume,
+                                   culture_ratio=culture_ratio,
+                                   strategy=strategy,
+                                   levels=levels,
+                                   return_result=True)
+
+        first = n_designs == 0
+        mode = 'w' if first else 'a'
+        result.volumes.to_csv(volumes_file, mode=mode, header=first)
+        result.conc_level.to_csv(conc_level_file, mode=mode, header=first)
+        if feasible_file is not None:
+            pd.DataFrame({'Feasible': result.feasible,
+                          'Status': result.status}).to_csv(feasible_file, mode=mode, header=first)
+
+        n_designs += len(chunk)
+        n_feasible += int(result.feasible.sum())
+
+    return n_designs, n_feasible
+
+
+def _screen_shard(args):
+    """Solve one shard of `screen_designs` (top level, so process pools can pickle it)."""
+    stock_high, stock_low, target_conc_val, well_volume, min_tip_volume, culture_ratio = args
+    return find_volumes_levels(stock_high, stock_low, target_conc_val,
+                               well_volume=well_volume,
+                               min_tip_volume=min_tip_volume,
+                               culture_ratio=culture_ratio)
+
+
+def screen_designs(df_stock: pd.DataFrame,
+                   target_conc_val: np.ndarray,
+                   well_volume: float,
+                   min_tip_volume: float,
+                   culture_ratio: int=100,
+                   workers: int=1,
+                   shard_size: int=100000,
+                   processes: bool=False,
+                   return_volumes: bool=False):
+    """Check which designs can be pipetted, sharding the designs over several workers.
+
+    Every shard is solved with `find_volumes_levels` and shards are merged in their original
+    order, so results do not depend on `workers`. Runs serially by default; whether threads or
+    processes are faster depends on the machine, see the `screen_designs` benchmarks in
+    `benchmarks/run_benchmarks.py`.
+
+    :param df_stock: Stock concentrations with 'High Concentration' and 'Low Concentration'
+        columns, in the order of the target columns.
+    :param target_conc_val: Target concentrations of shape (N, n), array or DataFrame.
+    :param workers: Number of workers, None for one per CPU.
+    :param shard_size: Number of designs solved by a worker at once.
+    :param processes: Use a process pool instead of threads.
+    :param return_volumes: Return the merged `BulkVolumes` instead of the feasibility only.
+    :return: Boolean array marking the feasible designs, or `BulkVolumes`.
+    """
+
+    target_conc_val = np.asarray(target_conc_val, dtype=float)
+    stock_high = df_stock['High Concentration'].values.astype(float)
+    stock_low = df_stock['Low Concentration'].values.astype(float)
+    starts = range(0, max(len(target_conc_val), 1), shard_size)
+    shards = [(stock_high, stock_low, target_conc_val[i:i + shard_size], well_volume, min_tip_volume, culture_ratio)
+              for i in starts]
+
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 1 or len(shards) <= 1:
+        results = [_screen_shard(shard) for shard in shards]
+    else:
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor(max_workers=workers) as pool:
+            results = list(pool.map(_screen_shard, shards))
+
+    if not return_volumes:
+        return np.concatenate([result.feasible for result in results])
+
+    return BulkVolumes(*(np.concatenate(field) for field in zip(*results)))
+
+
+def _read_bounds(bounds):
+    """Bounds as a DataFrame indexed by component, read from a file if given a path."""
+
+    if isinstance(bounds, str):
+        bounds = pd.read_csv(bounds)
+    if 'Variable' in bounds.columns:
+        bounds = bounds.set_index('Variable')
+    return bounds
+
+
+def _target_bounds(df_stand, bounds):
+    """Lower and upper target concentrations; components without bounds stay at the standard."""
+
+    lb = df_stand['Concentration'].astype(float).copy()
+    ub = lb.copy()
+    explored = [comp for comp in bounds.index if comp in lb.index]
+    lb[explored] = bounds.loc[explored, 'Min'].values
+    ub[explored] = bounds.loc[explored, 'Max'].values
+    return lb, ub, explored
+
+
+def box_corners(lb: np.ndarray, ub: np.ndarray, max_corners: int=2**16, seed: int=None):
+    """Corners of the box [lb, ub] as an array of shape (num_corners, n).
+
+    Only dimensions with lb != ub span the box. If there are more than `max_corners` corners,
+    a random subset is drawn that always includes the lowest and highest corner.
+    """
+
+    lb = np.asarray(lb, dtype=float)
+    ub = np.asarray(ub, dtype=float)
+    varying = np.flatnonzero(lb != ub)
+    k = len(varying)
+
+    if 2**k <= max_corners:
+        bits = (np.arange(2**k)[:, None] >> np.arange(k)) & 1
+    else:
+        rng = np.random.default_rng(seed)
+        bits = rng.integers(0, 2, size=(max_corners, k))
+        bits[0] = 0
+        bits[-1] = 1
+
+    corners = np.tile(lb, (len(bits), 1))
+    corners[:, varying] = np.where(bits, ub[varying], lb[varying])
+    return corners
+
+
+def check_stock_concentrations(df_stock: pd.DataFrame,
+                               df_stand: pd.DataFrame,
+                               bounds,
+                               well_volume: float,
+                               min_tip_volume: float,
+                               culture_ratio: int=100,
+                               n_samples: int=1000,
+                               max_corners: int=2**16,
+                               seed: int=None):
+    """Check stock concentrations on the corners of the bounds box and on LHS samples.
+
+    Besides the corners and the samples, the worst design is checked as well: every
+    explored component at the target just below the switch from high to low stock, or at
+    whichever bound needs the larger volume. Since components only share the water volume,
+    the stocks work for the whole box if and only if they work for that design.
+
+    :return: The checked target concentrations (DataFrame) and their feasibility (numpy array).
+    """
+
+    bounds = _read_bounds(bounds)
+    lb, ub, explored = _target_bounds(df_stand, bounds)
+    lb, ub = lb[df_stock.index].values, ub[df_stock.index].values
+    stock_high = df_stock['High Concentration'].values.astype(float)
+    stock_low = df_stock['Low Concentration'].values.astype(float)
+
+    corners = box_corners(lb, ub, max_corners=max_corners, seed=seed)
+
+    from pyDOE import lhs  # imported here so importing core does not load pyDOE
+    samples = lb + lhs(len(lb), samples=n_samples) * (ub - lb)
+
+    switch = np.clip(stock_high * (min_tip_volume - EPS) / well_volume, lb, ub)
+    worst = np.stack([lb, ub, switch])
+    worst_volumes = worst / np.where(worst >= stock_high * min_tip_volume / well_volume,
+                                     stock_high, stock_low)
+    worst = worst[np.argmax(worst_volumes, axis=0), np.arange(len(lb))]
+
+    target_conc_val = np.vstack([worst, corners, samples])
+    feasible = find_volumes_levels(stock_high, stock_low, target_conc_val,
+                                   well_volume=well_volume,
+                                   min_tip_volume=min_tip_volume,
+                                   culture_ratio=culture_ratio).feasible
+
+    df_targets = pd.DataFrame(target_conc_val, columns=df_stock.index)
+
+    return df_targets, feasible
+
+
+def find_stock_concentrations(df_stand: pd.DataFrame,
+                              bounds,
+                              well_volume: float,
+                              min_tip_volume: float,
+                              culture_ratio: int=100,
+                              significant_digits: int=3,
+                              n_samples: int=1000,
+                              verbose: bool=True):
+    """Find high and low stock concentrations for all components of the standard recipe.
+
+    Replaces the search in `A_Find_Stock_Concentrations.ipynb` with its closed-form solution.
+    For a component explored over [a, b], the low stock L = a * well_volume / min_tip_volume
+    (capped by solubility) is the most concentrated one that still reaches `a`. Targets below
+    H * min_tip_volume / well_volume take the low stock, so the largest volume for a
+    component is max(well_volume * b / H, H * min_tip_volume / L), which is smallest for
+    H = sqrt(well_volume * b * L / min_tip_volume), capped by solubility. Components without
+    bounds get a single stock giving `min_tip_volume` at the standard concentration.
+    Concentrations are rounded down to `significant_digits`.
+
+    :param df_stand: Standard recipe with 'Concentration' and optionally 'Solubility'
+        columns, indexed by component.
+    :type df_stand: pandas DataFrame
+    :param bounds: Path to a bounds file, or a DataFrame with 'Min' and 'Max' columns.
+    :param well_volume: Total volume of the well (media and culture).
+    :param min_tip_volume: Minimal transfer volume of the liquid handler.
+    :param culture_ratio: Dilution factor for the culture.
+    :param significant_digits: Number of significant digits kept in the concentrations.
+    :param n_samples: Number of LHS samples used to check the concentrations.
+    :return: DataFrame with 'Low Concentration', 'High Concentration' and 'Dilution Factor'
+        for each component, in the format of `stock_concentrations.csv`.
+    :raises ValueError: If a lower bound (or standard concentration) is not positive.
+    """
+
+    bounds = _read_bounds(bounds)
+    lb, ub, explored = _target_bounds(df_stand, bounds)
+    if not (lb > 0).all():
+        raise ValueError('Lower bounds (or standard concentrations) are not positive for: '
+                         + ', '.join(map(str, lb.index[~(lb > 0)])))
+
+    if 'Solubility' in df_stand.columns:
+        solubility = df_stand['Solubility'].astype(float).fillna(np.inf).values
+    else:
+        solubility = np.full(len(df_stand), np.inf)
+
+    a, b = lb.values, ub.values
+    stock_low = np.minimum(a * well_volume / min_tip_volume, solubility)
+    stock_high = np.sqrt(well_volume * b * stock_low / min_tip_volume)
+    stock_high = np.clip(stock_high, stock_low, solubility)
+
+    # Round down, so that lower bounds stay reachable and solubility is respected
+    magnitude = 10.**(np.floor(np.log10(stock_low)) - significant_digits + 1)
+    stock_low = np.floor(stock_low / magnitude + EPS) * magnitude
+    magnitude = 10.**(np.floor(np.log10(stock_high)) - significant_digits + 1)
+    stock_high = np.maximum(np.floor(stock_high / magnitude + EPS) * magnitude, stock_low)
+
+    df_stock = pd.DataFrame(index=df_stand.index)
+    df_stock['Low Concentration'] = stock_low
+    df_stock['High Concentration'] = stock_high
+    df_stock['Dilution Factor'] = np.round(stock_high / stock_low, 2)
+
+    df_targets, feasible = check_stock_concentrations(df_stock, df_stand, bounds,
+                                                      well_volume=well_volume,
+                                                      min_tip_volume=min_tip_volume,
+                                                      culture_ratio=culture_ratio,
+                                                      n_samples=n_samples)
+    if verbose:
+        print(f'Feasible designs: {100*feasible.mean():.2f}% of {len(feasible)} '
+              f'(worst case, corners and LHS samples)')
+    if not feasible.any():
+        warnings.warn(NoFeasibleVolumesWarn())
+    elif not feasible.all():
+        warnings.warn(PartiallyFeasibleVolumesWarn(feasible.mean()))
+
+    return df_stock
+
+
+def pack_source_wells(volumes: np.ndarray, capacity):
+    """First-fit packing of transfers into source wells, in the order they are given.
+
+    :param volumes: Volume of each transfer.
+    :param capacity: Usable volume (without dead volume) of the source wells: either a
+        single value, in which case new wells are opened as needed, or an array with one
+        value per existing well.
+    :return: Index of the source well for each transfer, -1 where no well has room for it.
+    """
+
+    volumes = np.asarray(volumes, dtype=float)
+    growing = np.ndim(capacity) == 0
+    remaining = np.array([] if growing else capacity, dtype=float)
+    assigned = np.full(len(volumes), -1)
+
+    for i, volume in enumerate(volumes):
+        fits = np.flatnonzero(remaining >= volume)
+        if len(fits):
+            assigned[i] = fits[0]
+        elif growing and volume <= capacity:
+            remaining = np.append(remaining, capacity)
+            assigned[i] = len(remaining) - 1
+        else:
+            continue
+        remaining[assigned[i]] -= volume
+
+    return assigned
+
+
+def create_stock_plate(df_stock_plate: pd.DataFrame,
+                       df_volumes: pd.DataFrame,
+                       df_conc_level: pd.DataFrame,
+                       conc_level: str,
+                       well_volume: float=9000,
+                       dead_volume: float=100,
+                       well_rows: str='ABCD',
+                       well_columns: str='123456'):
+    """Volumes of a stock plate, with components split over as many wells as their transfers need.
+
+    Replaces the "We need N well(s)" cells of `D_Create_Transfers.ipynb`. The transfers of
+    each component taken at `conc_level` are packed first-fit (in destination order) into
+    wells holding `well_volume` including `dead_volume`. Extra wells follow the wells of the
+    layout and all wells are named column-wise (A1, B1, ... D1, A2, ...).
+
+    :param df_stock_plate: Stock plate layout with 'Component' and 'Concentration[mM]' columns.
+    :param df_volumes: Transfer volumes, as returned by `find_volumes_bulk`.
+    :param df_conc_level: Stock level of every transfer, as returned by `find_volumes_bulk`.
+    :param conc_level: Stock level held by this plate, e.g. 'high' or 'low'.
+    :param well_volume: Maximal volume of a source well, including dead volume.
+    :param dead_volume: Volume that can not be pipetted out of a source well.
+    :return: The stock plate indexed by 'Well', with a 'Volume [uL]' column, and a DataFrame
+        like `df_volumes` with the source well of every transfer made from this plate.
+    """
+
+    df_layout = df_stock_plate.drop_duplicates(subset='Component').reset_index(drop=True)
+    df_source_wells = pd.DataFrame(None, index=df_volumes.index, columns=df_layout['Component'], dtype=object)
+
+    packing, wells, extra_wells = {}, [], []
+    for i, comp in enumerate(df_layout['Component']):
+        if comp in df_volumes.columns:
+            taken = (df_conc_level[comp] == conc_level).values
+        else:
+            taken = np.zeros(len(df_volumes), dtype=bool)
+        volumes = df_volumes[comp].values[taken] if taken.any() else np.array([])
+        assigned = pack_source_wells(volumes, well_volume - dead_volume)
+        if (assigned < 0).any():
+            raise ValueError(f'Transfer of {comp} larger than a source well ({well_volume} uL)')
+
+        # The first well keeps its place in the layout, extra wells go at the end
+        used = np.bincount(assigned, weights=volumes, minlength=1)
+        numbers = [len(wells)] + list(range(len(extra_wells), len(extra_wells) + len(used) - 1))
+        wells.append((i, used[0]))
+        extra_wells.extend((i, volume) for volume in used[1:])
+        packing[comp] = (taken, assigned, numbers)
+
+    well_names = [f'{row}{column}' for column in well_columns for row in well_rows]
+    if len(wells) + len(extra_wells) > len(well_names):
+        raise ValueError(f'Stock plate needs {len(wells) + len(extra_wells)} wells, '
+                         f'but only has {len(well_names)}')
+
+    for comp, (taken, assigned, numbers) in packing.items():
+        names = np.array([well_names[numbers[0]]] +
+                         [well_names[len(wells) + n] for n in numbers[1:]], dtype=object)
+        if taken.any():
+            df_source_wells.loc[taken, comp] = names[assigned]
+
+    wells = wells + extra_wells
+    df_plate = df_layout.loc[[i for i, _ in wells]].reset_index(drop=True)
+    df_plate['Volume [uL]'] = np.ceil([volume for _, volume in wells]) + dead_volume
+    df_plate['Well'] = well_names[:len(wells)]
+
+    return df_plate.set_index('Well'), df_source_wells
+
+
+class SubTransfers(NamedTuple):
+    """Sub-transfers of one head, as parallel arrays."""
+    well: np.ndarray       # row of the volume matrix (destination well)
+    component: np.ndarray  # column of the volume matrix (component)
+    volume: np.ndarray     # volume of each sub-transfer [uL]
+
+
+def select_tips(tips=('f20', 'f200')) -> List[Tip]:
+    """Tips to use, one per head (the first one listed wins), from the smallest head up.
+
+    :param tips: Names of the available tips, keys of `tip_registry`.
+    """
+
+    unknown = [tip for tip in tips if tip not in tip_registry]
+    if unknown:
+        raise ValueError(f'Unknown tips: {unknown} (use some of {list(tip_registry)})')
+
+    heads = {}
+    for tip in tips:
+        heads.setdefault(tip_registry[tip].head, tip_registry[tip])
+
+    return sorted(heads.values(), key=lambda tip: (tip.use_below, tip.max_volume))
+
+
+def choose_heads(volumes: np.ndarray, heads: List[Tip]) -> np.ndarray:
+    """Index in `heads` of the head taking each volume: the first whose `use_below` the
+    volume is under, and the largest head for everything else."""
+
+    use_below = np.array([tip.use_below for tip in heads[:-1]], dtype=float)
+    return np.searchsorted(use_below, volumes, side='right')
+
+
+def split_transfers(volumes: np.ndarray, tips=('f20', 'f200')) -> Dict[str, SubTransfers]:
+    """Split every transfer of a volume matrix into sub-transfers for each head, in one pass.
+
+    Each volume goes to a head as in `choose_heads` and is split into
+    ceil(volume / max_volume) equal sub-transfers, as in `D_Create_Transfers.ipynb`.
+    Zero volumes are skipped.
+
+    :param volumes: Transfer volumes of shape (wells, components), e.g. `df_volumes.values`.
+    :param tips: Names of the available tips, keys of `tip_registry`.
+    :return: Sub-transfers for each head name, ordered by component and then by well.
+    :raises ValueError: If a volume is negative (an infeasible design).
+    """
+
+    volumes = np.atleast_2d(np.asarray(volumes, dtype=float))
+    if (volumes < 0).any():
+        raise ValueError(f'Negative volumes in wells: {np.unique(np.nonzero(volumes < 0)[0]).tolist()}')
+    heads = select_tips(tips)
+
+    component, well = np.nonzero(volumes.T > 0)
+    volume = volumes[well, component]
+    head = choose_heads(volume, heads)
+    max_volume = np.array([tip.max_volume for tip in heads])[head]
+    num_transfers = np.ceil(volume / max_volume).astype(int)
+
+    sub = np.repeat(np.arange(len(volume)), num_transfers)
+    volume = volume / num_transfers
+
+    transfers = {}
+    for i, tip in enumerate(heads):
+        taken = sub[head[sub] == i]
+        transfers[tip.head] = SubTransfers(well[taken], component[taken], volume[taken])
+
+    return transfers
+
+
 def find_dilutions(volumes):
     # TODO
     num_components = len(volumes)
@@ -231,27 +1365,35 @@ def find_dilutions(volumes):
     return dilutions
 
 
-def round_volume(volume: np.ndarray, well_volume: int):
+def round_volume(volume: np.ndarray, well_volume: int, return_error: bool=False):
     """Volumes for transfers are rounded to integers if within 50-300ul and to one decimal digit if within 1-50ul 
     (taking into account pipettes' errors).
-    Ceil rather than round is needed because we cannot make higher concentrations in subsequent iterations."""
-
-    volume_rnd = volume.copy()
-    for i in range(len(volume_rnd)):
-        if volume[i] < pip_volume_threshold:
-            volume_rnd[i] = float_round(volume[i], 1, ceil)
-            if volume_rnd[i] == well_volume:
-                volume_rnd[i] = float_round(volume[i], 1, round)
-        else:
-            volume_rnd[i] = float_round(volume[i], 0, ceil)
-            if volume_rnd[i] == well_volume:
-                volume_rnd[i] = float_round(volume[i], 0, round)
+    Ceil rather than round is needed because we cannot make higher concentrations in subsequent iterations.
+
+    Works on volumes of any shape, e.g. the (N, n) matrices of `find_volumes_batch`. With
+    `return_error` also returns the rounding error (rounded - volume) of every volume; the
+    relative concentration drift of a component is that error divided by its volume."""
+
+    volume = np.asarray(volume)
+    scale = np.where(volume < pip_volume_threshold, 10., 1.)
+    scaled = volume * scale
+
+    volume_rnd = np.ceil(scaled) / scale
+    volume_rnd = np.where(volume_rnd == well_volume, np.rint(scaled) / scale, volume_rnd)
+
+    if return_error:
+        return volume_rnd, volume_rnd - volume
+
+    return volume_rnd
 
-    return np.array(volume_rnd)
+
+# NumPy versions of the rounding directions accepted by float_round
+_round_ufuncs = {ceil: np.ceil, floor: np.floor, round: np.rint}
 
 
 def float_round(num, places=0, direction=ceil):
-    return direction(num * (10**places)) / float(10**places)
+    rounded = _round_ufuncs.get(direction, direction)(np.multiply(num, 10**places)) / float(10**places)
+    return float(rounded) if np.ndim(rounded) == 0 else rounded
 
 
 def create_media_description(series: pd.Series):
@@ -262,105 +1404,162 @@ def create_media_description(series: pd.Series):
     return description[:-2]
 
 
+def _whitegrid_style():
+    """The seaborn whitegrid matplotlib style, under its name in the installed matplotlib."""
+    import matplotlib.style
+    return 'seaborn-whitegrid' if 'seaborn-whitegrid' in matplotlib.style.available else 'seaborn-v0_8-whitegrid'
+
+
+def _draw_pairwise_panel(ax, layers, var1, var2, bins=50, max_points=None):
+    """Draw `layers` (label, points, color, marker sizes) for components `var1` (x) and `var2` (y).
+
+    With `max_points`, layers with more points are drawn as a 2D histogram of `bins` bins per
+    axis (log color scale) and the other layers are rasterized.
+    """
+
+    from matplotlib.colors import LinearSegmentedColormap, LogNorm
+
+    for label, X, color, sizes in layers:
+        x, y = X[:, var1], X[:, var2]
+        if max_points is not None and len(x) > max_points:
+            counts, xedges, yedges = np.histogram2d(x, y, bins=bins)
+            ax.imshow(np.ma.masked_equal(counts.T, 0),
+                      origin='lower',
+                      aspect='auto',
+                      interpolation='nearest',
+                      extent=(xedges[0], xedges[-1], yedges[0], yedges[-1]),
+                      cmap=LinearSegmentedColormap.from_list(label, ['white', color]),
+                      norm=LogNorm())
+        else:
+            ax.scatter(x, y, c=color, marker="+", s=sizes, lw=1, label=label,
+                       rasterized=max_points is not None)
+
+
+def _render_pairwise_panel(task):
+    """One panel of `designs_pairwise` as an RGBA image (top level, so process pools can pickle it).
+
+    Without labels the panel is the legend of `layers`.
+    """
+
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.lines import Line2D
+
+    layers, xlabel, ylabel, size, dpi, bins, max_points = task
+    with matplotlib.style.context(_whitegrid_style()):
+        fig = Figure(figsize=(size, size), dpi=dpi, facecolor='white')
+        canvas = FigureCanvasAgg(fig)
+        if xlabel is None:
+            handles = {label: Line2D([], [], color=color, marker="+", linestyle="", markersize=10, label=label)
+                       for label, _, color, _ in layers}
+            fig.legend(handles=list(handles.values()), loc="center", shadow=True)
+        else:
+            # Fixed margins and few ticks, the layout engines take longer than the drawing
+            fig.subplots_adjust(left=0.2, bottom=0.2, right=0.96, top=0.96)
+            ax = fig.add_subplot()
+            _draw_pairwise_panel(ax, layers, 0, 1, bins=bins, max_points=max_points)
+            ax.locator_params(nbins=4)
+            ax.set_xlabel(xlabel)
+            ax.set_ylabel(ylabel)
+        canvas.draw()
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+
 def designs_pairwise(art, 
                      df_rec, 
                      user_params, 
 #                      initial=False, 
                      df_train=None,
-                     df_control=None
+                     df_control=None,
+                     fast=False,
+                     dpi=300,
+                     max_points=2000,
+                     bins=50,
+                     workers=1,
+                     figsize=(35, 35),
+                     output_file=None
                     ):
+    """Pairwise scatter plots of the designs for all pairs of components, saved to
+    `output_file` (`designs_pairwise.png` in `art.outDir` by default).
 
-    dim = art.num_input_var
-
-    plt.style.use('seaborn-whitegrid')
+    With `fast`, every panel is rendered on its own, by `workers` processes (None for one per
+    CPU), and tiled into one image, which is returned instead of the figure. Point sets larger
+    than `max_points` are then drawn as 2D histograms with `bins` bins, so plotting time and
+    memory stay flat in the number of designs. A low `dpi` (e.g. 72) gives a quick preview.
+    """
 
-    fig = plt.figure(figsize=(35, 35))
-    fig.patch.set_facecolor("white")
+    dim = art.num_input_var
+    components = user_params['components']
+    output_file = output_file if output_file is not None else f'{art.outDir}/designs_pairwise.png'
 
-    X = df_rec[user_params['components']].values
-    
+    # Point sets drawn in every panel: label, points (N x dim), color, marker sizes
+    scale = 100 if df_train is None else 150*df_rec['OD340_pred'].values
+    layers = []
     if df_train is not None:
-        X_train = df_train[user_params['components']].values
-        standard = df_train[df_train['Label']=='standard'].drop(columns='Label').values
-        
+        standard = df_train[df_train['Label']=='standard']
+        layers.append(("Train data", df_train[components].values, "r", 150*df_train['OD340'].values))
+        layers.append(("Standard", standard[components].values, "k", 150*standard['OD340'].values.astype(float)))
+    layers.append(("Recommendations", df_rec[components].values, "g", scale))
     if df_control is not None:
-        X_control = df_control[user_params['components']].values
+        layers.append(("Control", df_control[components].values, "k", scale))
+    if df_train is not None:
+        # The last recommendation is the standard recipe
+        layers.append(("Standard", df_rec[components].values[-1:], "k", scale[-1:]))
+
+    pairs = [(var1, var2) for var1 in range(dim) for var2 in range(var1 + 1, dim)]
 
-    for var1 in range(dim):
-        for var2 in range(var1 + 1, dim):
+    if fast:
+        import matplotlib.image
 
+        size = min(figsize) / dim
+        tasks = [([(label, X[:, [var1, var2]], color, sizes) for label, X, color, sizes in layers],
+                  art.input_vars[var1], art.input_vars[var2], size, dpi, bins, max_points)
+                 for var1, var2 in pairs]
+        tasks.append(([(label, None, color, None) for label, _, color, _ in layers],
+                      None, None, size, dpi, bins, max_points))
+        workers = os.cpu_count() if workers is None else workers
+        if workers == 1 or len(tasks) <= 1:
+            images = [_render_pairwise_panel(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                images = list(pool.map(_render_pairwise_panel, tasks))
+
+        # Panels below the diagonal, the legend in the empty top right corner
+        height, width = images[0].shape[:2]
+        grid = np.full((dim * height, dim * width, 4), 255, dtype=np.uint8)
+        for (var1, var2), image in zip(pairs + [(dim - 1, 0)], images):
+            grid[var2 * height:(var2 + 1) * height, var1 * width:(var1 + 1) * width] = image
+        matplotlib.image.imsave(output_file, grid, dpi=dpi)
+        return grid
+
+    import matplotlib.pyplot as plt  # imported here so importing core does not load matplotlib
+    from matplotlib.lines import Line2D
+
+    with plt.style.context(_whitegrid_style()):
+        fig = plt.figure(figsize=figsize)
+        fig.patch.set_facecolor("white")
+
+        for var1, var2 in pairs:
             ax = fig.add_subplot(dim, dim, (var2 * dim + var1 + 1))
-            
-            if df_train is not None:
-                ax.scatter(
-                    X_train[:, var1],
-                    X_train[:, var2],
-                    c="r",
-                    marker="+",
-                    s=150*df_train['OD340'],
-                    lw=1,
-                    label="Train data",
-                )
-
-                ax.scatter(
-                    standard[:, var1],
-                    standard[:, var2],
-                    c="k",
-                    marker="+",
-                    s=150*standard[:, -1].astype(float),
-                    lw=1,
-                    label="Standard",
-                )
-            
-            scale = 100 if df_train is None else 150*df_rec['OD340_pred']
-            
-            ax.scatter(
-                X[:, var1],
-                X[:, var2],
-                c="g",
-                marker="+",
-                s=scale,
-                lw=1,
-                label="Recommendations",
-            )
-            
-            if df_control is not None:
-                ax.scatter(
-                X_control[:, var1],
-                X_control[:, var2],
-                c="k",
-                edgecolor="k",
-                marker="+",
-                s=scale,
-                lw=1,
-                label="Standard",
-            )
-            
-            if df_train:
-                scale = 150*df_rec['OD340_pred'].values[-1]
-                ax.scatter(
-                    X[-1, var1],
-                    X[-1, var2],
-                    c="k",
-                    marker="+",
-                    s=scale,
-                    lw=1,
-                    label="Standard",
-                )
-                                   
+            _draw_pairwise_panel(ax, layers, var1, var2)
             if var2 == (dim - 1):
                 ax.set_xlabel(art.input_vars[var1])
             if var1 == 0:
                 ax.set_ylabel(art.input_vars[var2])
-                if var2 == 0:
-                    ax.legend(loc="center left", bbox_to_anchor=(1, 0.5), shadow=True)
-
-    fig.savefig(
-        f'{art.outDir}/designs_pairwise.png',
-        bbox_inches="tight",
-        transparent=False, 
-        dpi=300
-    )
+
+        handles = {label: Line2D([], [], color=color, marker="+", linestyle="", markersize=10, label=label)
+                   for label, _, color, _ in layers}
+        fig.legend(handles=list(handles.values()), loc="upper right", shadow=True)
+
+        fig.savefig(
+            output_file,
+            bbox_inches="tight",
+            transparent=False, 
+            dpi=dpi
+        )
+
+    return fig
     
 
 def map_01_to_bounds(df, bounds_file, df_stand, fraction): 
@@ -368,7 +1567,7 @@ def map_01_to_bounds(df, bounds_file, df_stand, fraction):
     
     :param df: A pandas DataFrame object with values for each component, e.g. a recommendations dataframe output from ART 
     :type df: pandas DataFrame
-    :param bounds_file: The path to a bounds file (Excel or CSV format).
+    :param bounds_file: The path to a bounds file (Excel or CSV format), or a DataFrame with 'Min' and 'Max' columns.
     :type bounds_file: string
     :param df_stand: A pandas DataFrame object with standard media concentrations. Loaded from the standard recipe file.
     :type df_stand: pandas DataFrame
@@ -376,29 +1575,257 @@ def map_01_to_bounds(df, bounds_file, df_stand, fraction):
     :type fraction: float
     """
     
-    df_ranges = df.copy()
-    
-    df_bounds = pd.read_csv(bounds_file).set_index('Variable')
-    
-    for component in df.columns:
-        lb = df_bounds.at[component, 'Min']
-        ub = df_bounds.at[component, 'Max']
-        stand = df_stand.at[component,'Concentration']
-        
-        df_ranges[component] = [
-            lb + (stand - lb)*r/fraction if r < fraction else stand + (ub - stand)*(r-fraction)/(1-fraction) 
-            for r in df[component]
-        ]
+    df_bounds = _read_bounds(bounds_file)
+    components = list(df.columns)
+
+    values = _map_01(df.values.astype(float),
+                     df_bounds.loc[components, 'Min'].values.astype(float),
+                     df_bounds.loc[components, 'Max'].values.astype(float),
+                     df_stand.loc[components, 'Concentration'].values.astype(float),
+                     fraction)
+
+    return pd.DataFrame(values, index=df.index, columns=df.columns)
+
+
+def _map_01(r, lb, ub, stand, fraction):
+    """Piecewise linear map of [0, 1] to [lb, ub], with `fraction` of the interval below `stand`."""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        below = lb + (stand - lb) * r / fraction
+        above = stand + (ub - stand) * (r - fraction) / (1 - fraction)
+    return np.where(r < fraction, below, above)
+
+
+def latin_hypercube(n: int, samples: int, seed=None) -> np.ndarray:
+    """Latin hypercube samples in [0, 1]^n, like `pyDOE.lhs` but with its own random generator."""
+
+    rng = np.random.default_rng(seed)
+    strata = rng.permuted(np.tile(np.arange(samples), (n, 1)), axis=1).T
+    return (strata + rng.random((samples, n))) / samples
 
-    return df_ranges
+
+def maximin_subset(points: np.ndarray, k: int) -> np.ndarray:
+    """Indices of `k` of the `points` picked greedily so that each one is the farthest from those picked before."""
+
+    if k >= len(points):
+        return np.arange(len(points))
+
+    chosen = [0]
+    distance = np.linalg.norm(points - points[0], axis=1)
+    for _ in range(k - 1):
+        chosen.append(int(np.argmax(distance)))
+        distance = np.minimum(distance, np.linalg.norm(points - points[chosen[-1]], axis=1))
+    return np.array(chosen)
+
+
+def sample_designs(lb: np.ndarray,
+                   ub: np.ndarray,
+                   n_designs: int,
+                   feasible=None,
+                   stand: np.ndarray=None,
+                   fraction: float=0.5,
+                   batch_size: int=None,
+                   max_batches: int=20,
+                   oversample: int=4,
+                   seed=None) -> np.ndarray:
+    """Space-filling designs in [lb, ub] that all pass a feasibility check.
+
+    Latin hypercube batches are mapped to the bounds (piecewise around `stand` if given, as in
+    `map_01_to_bounds`) and filtered with `feasible`, until `oversample * n_designs` feasible
+    candidates are found or `max_batches` batches are drawn. The designs are then picked from
+    the candidates with `maximin_subset`, which keeps them spread over the space.
+
+    :param lb: Lower bounds of shape (n,).
+    :param ub: Upper bounds of shape (n,).
+    :param n_designs: Number of designs.
+    :param feasible: Function of an (N, n) array of designs returning a boolean mask, None if all are.
+    :param stand: Standard concentrations of shape (n,) for the piecewise mapping.
+    :param fraction: Fraction of the [0, 1] interval mapped below `stand`.
+    :param batch_size: Number of designs drawn per batch, `oversample * n_designs` by default.
+    :return: Designs of shape (n_designs, n), fewer if not enough feasible ones were found.
+    """
+
+    lb, ub = np.asarray(lb, dtype=float), np.asarray(ub, dtype=float)
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size or oversample * n_designs
+
+    candidates, designs = [], []
+    for _ in range(max_batches):
+        r = latin_hypercube(len(lb), batch_size, seed=rng)
+        if stand is None:
+            values = lb + (ub - lb) * r
+        else:
+            values = _map_01(r, lb, ub, np.asarray(stand, dtype=float), fraction)
+        ok = np.ones(len(values), dtype=bool) if feasible is None else np.asarray(feasible(values))
+        candidates.append(r[ok])
+        designs.append(values[ok])
+        if sum(len(c) for c in candidates) >= oversample * n_designs:
+            break
+
+    candidates, designs = np.concatenate(candidates), np.concatenate(designs)
+    if not len(designs):
+        warnings.warn(NoFeasibleVolumesWarn())
+    elif len(designs) < n_designs:
+        warnings.warn(TooFewFeasibleDesignsWarn(len(designs), n_designs))
+
+    return designs[maximin_subset(candidates, n_designs)]
+
+
+def sample_feasible_designs(df_stock: pd.DataFrame,
+                            df_stand: pd.DataFrame,
+                            bounds,
+                            n_designs: int,
+                            well_volume: float,
+                            min_tip_volume: float,
+                            culture_ratio: int=100,
+                            fraction: float=0.5,
+                            seed=None,
+                            **kwargs) -> pd.DataFrame:
+    """Space-filling target concentrations that can all be pipetted with the given stocks.
+
+    Explored components are sampled with `sample_designs` between their bounds, around the
+    standard recipe; the others stay at the standard. Only designs that `find_volumes_levels`
+    can pipette are kept.
+
+    :param df_stock: Stock concentrations with 'High Concentration' and 'Low Concentration' columns.
+    :param df_stand: Standard recipe with a 'Concentration' column, indexed by component.
+    :param bounds: Path to a bounds file, or a DataFrame with 'Min' and 'Max' columns.
+    :param n_designs: Number of designs.
+    :param kwargs: Passed to `sample_designs` (batch_size, max_batches, oversample).
+    :return: Target concentrations with one row per design, in the column order of `df_stock`.
+    """
+
+    bounds = _read_bounds(bounds)
+    lb, ub, explored = _target_bounds(df_stand.loc[df_stock.index], bounds)
+    stand = df_stand.loc[df_stock.index, 'Concentration'].astype(float)
+    columns = [df_stock.index.get_loc(comp) for comp in explored]
+
+    def feasible(values):
+        targets = np.tile(stand.values, (len(values), 1))
+        targets[:, columns] = values
+        return find_volumes_levels(df_stock['High Concentration'].values.astype(float),
+                                   df_stock['Low Concentration'].values.astype(float),
+                                   targets,
+                                   well_volume=well_volume,
+                                   min_tip_volume=min_tip_volume,
+                                   culture_ratio=culture_ratio).feasible
+
+    values = sample_designs(lb[explored].values, ub[explored].values, n_designs,
+                            feasible=feasible,
+                            stand=stand[explored].values,
+                            fraction=fraction,
+                            seed=seed,
+                            **kwargs)
+
+    df_designs = pd.DataFrame(np.tile(stand.values, (len(values), 1)), columns=df_stock.index)
+    df_designs[explored] = values
+    return df_designs
 
 
 class MediaWarning(Warning):
     pass
+
+
+class InfeasibleVolumesError(ValueError):
+    """Designs that cannot be made, with their combined `Infeasible` reason flags."""
+
+    def __init__(self, reason, designs=None):
+        self.reason = Infeasible(int(reason))
+        self.designs = designs
+        message = ' '.join(message for flag, message in reason_messages.items() if flag & self.reason)
+        if designs is not None:
+            message = f'Infeasible designs {", ".join(map(str, designs))}: {message}'
+        super().__init__(message)
     
     
 class NoFeasibleVolumesWarn(MediaWarning):
     def __str__(self):
         return (
             "No feasible volumes are found!"
-        )
\ No newline at end of file
+        )
+
+
+class PartiallyFeasibleVolumesWarn(MediaWarning):
+    def __init__(self, fraction):
+        self.fraction = fraction
+        super().__init__(fraction)
+
+    def __str__(self):
+        return (
+            f"Feasible volumes are found for only {100*self.fraction:.2f}% of the designs!"
+        )
+
+
+class TooFewFeasibleDesignsWarn(MediaWarning):
+    def __init__(self, found, requested):
+        self.found = found
+        self.requested = requested
+        super().__init__(found, requested)
+
+    def __str__(self):
+        return (
+            f"Only {self.found} of the {self.requested} requested feasible designs are found!"
+        )
+
+
+def main(argv=None):
+    """Find transfer volumes for a target concentrations file from the command line.
+
+    Example::
+
+        python -m core stock_concentrations.csv target_concentrations.csv \\
+            --standard-media-file standard_recipe_concentrations.csv \\
+            --well-volume 1500 --min-tip-volume 5 --output-dir DBTL6
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m core',
+                                     description='Find transfer volumes for target concentrations. Writes '
+                                                 'dest_volumes.csv, conc_levels.csv and feasible.csv; exits '
+                                                 'with status 1 when some designs are infeasible.')
+    parser.add_argument('stock_conc_file',
+                        help="stock concentrations by component, with 'High Concentration' and "
+                             "'Low Concentration' columns")
+    parser.add_argument('target_conc_file', help='target concentrations, one design per row')
+    parser.add_argument('--standard-media-file',
+                        help="standard recipe ('Concentration' column) for components not in the targets")
+    parser.add_argument('--well-volume', type=float, required=True, help='total volume of the well [uL]')
+    parser.add_argument('--min-tip-volume', type=float, required=True, help='minimal transfer volume [uL]')
+    parser.add_argument('--culture-ratio', type=float, default=100, help='dilution factor for the culture')
+    parser.add_argument('--strategy', choices=['fallback', 'optimal'], default='fallback')
+    parser.add_argument('--chunksize', type=int, default=10000, help='designs solved at once')
+    parser.add_argument('--output-dir', default='.')
+    args = parser.parse_args(argv)
+
+    try:
+        df_stock = read_stock_concentrations(args.stock_conc_file)
+    except ValueError as error:
+        parser.error(str(error))
+
+    fixed = None
+    if args.standard_media_file is not None:
+        fixed = pd.read_csv(args.standard_media_file, index_col=0)['Concentration']
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    try:
+        n_designs, n_feasible = find_volumes_stream(df_stock,
+                                                    args.target_conc_file,
+                                                    os.path.join(args.output_dir, 'dest_volumes.csv'),
+                                                    os.path.join(args.output_dir, 'conc_levels.csv'),
+                                                    os.path.join(args.output_dir, 'feasible.csv'),
+                                                    well_volume=args.well_volume,
+                                                    min_tip_volume=args.min_tip_volume,
+                                                    culture_ratio=args.culture_ratio,
+                                                    fixed=fixed,
+                                                    chunksize=args.chunksize,
+                                                    strategy=args.strategy)
+    except ValueError as error:
+        parser.error(str(error))
+
+    print(f'Feasible designs: {n_feasible} of {n_designs}')
+    return 0 if n_feasible == n_designs else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
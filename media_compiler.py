@@ -1,18 +1,21 @@
 import pandas as pd
-from IPython.display import display
-import matplotlib.pyplot as plt
 import numpy as np
-from pyDOE import lhs
 import math
+import os
+import sys
+import csv
+import contextlib
+import heapq
+import re
+
+from core import pack_source_wells, select_tips, choose_heads, tip_registry, sample_designs, profiled, profile_count, profile_stage
 
 #Magic Numbers
-min_volume = 5     #uL per well
 max_volume = 1200  #uL per well
 
-#Transfer Volume (Property of the Pipette)
-#Might want to make a Pipette Class
-min_transfer = 5   #uL
-max_transfer = 180 #uL
+#Transfer Volume (Property of the Pipette, Tip Types Live in core.tip_registry)
+tips = ['f20','f200']   #default tips, compile_media(tips=...) takes others
+transfer_margin = 10    #uL, largest transfer kept below the largest tip
 
 #Plate Limits
 #This should probably be cleaned up
@@ -22,146 +25,596 @@ DILUTION_SAFETY_FACTOR = 2
 ideal_transfer_volume = 8 #uL
 dilution_volume = ideal_transfer_volume
 
+#Plate Formats (Number of Wells -> Rows, Columns)
+plate_formats = {24:(4,6), 96:(8,12), 384:(16,24)}
+
+#Columns of The Plates generate_initial_media Lays Out (Wells Numbered Row-Major), & Plates Used as Reservoirs
+deck_plate_columns = {'src_plate':12, 'dest_plate':8, 'water_plate':12}
+reservoir_plates = ('water_plate',)
+
+
+#Number of wells reserved on the deck each time a plate runs out of space
+default_plate_capacity = 96
+
+#Multichannel Pipetting
+num_channels = 8   #probes on the head
+tips_per_box = 96
+
+def transfer_limits(heads):
+    '''Smallest & Largest Single Transfer For a Set of Pipetting Heads'''
+    return min(tip.min_volume for tip in heads),max(tip.max_volume for tip in heads) - transfer_margin
+
+#Pipetting Heads For The Default Tips, Smallest First
+pipette_heads = select_tips(tips)
+min_transfer,max_transfer = transfer_limits(pipette_heads)
+
+#Tip Reuse Policies, From Most to Least Careful
+tip_reuse_policies = ('never','water','source')
+
+
+#Deck State, Stored as a Dense (Wells x Reagents) Array Instead of a DataFrame
+class Deck(object):
+    
+    def __init__(self,columns,plate_capacity=default_plate_capacity):
+        self.columns = list(columns)
+        self.volume_column = self.columns.index('Volume')
+        self.plate_capacity = plate_capacity
+        
+        self.state = np.zeros((plate_capacity,len(self.columns)))
+        self.well_index = {}        #(plate,well) -> row in state
+        self.wells = []             #row in state -> (plate,well)
+        self.free_rows = {}         #plate -> list of reserved, unused rows
+        self.num_rows = 0
+        
+        
+    @classmethod
+    def from_frame(cls,deck_df,plate_capacity=default_plate_capacity):
+        '''Create a Deck from a DataFrame Indexed by (Plate,Well)'''
+        deck = cls(deck_df.columns,plate_capacity=plate_capacity)
+        rows = [deck.add_well(plate,well) for plate,well in deck_df.index]
+        deck.state[rows] = deck_df.values.astype(float)
+        return deck
+        
+        
+    def add_well(self,plate,well):
+        '''Add an Empty Well, Reserving Space For The Rest of Its Plate'''
+        if not self.free_rows.get(plate):
+            self.reserve(plate,self.plate_capacity)
+        row = self.free_rows[plate].pop()
+        self.well_index[(plate,well)] = row
+        self.wells[row] = (plate,well)
+        return row
+        
+        
+    def reserve(self,plate,num_wells):
+        start = self.num_rows
+        self.num_rows += num_wells
+        if self.num_rows > len(self.state):
+            state = np.zeros((max(self.num_rows,2*len(self.state)),len(self.columns)))
+            state[:start] = self.state[:start]
+            self.state = state
+        self.wells.extend([None]*num_wells)
+        self.free_rows[plate] = list(range(self.num_rows - 1,start - 1,-1)) + self.free_rows.get(plate,[])
+        
+        
+    def row(self,plate,well,create=False):
+        try:
+            return self.well_index[(plate,well)]
+        except KeyError:
+            if not create:
+                raise
+            return self.add_well(plate,well)
+            
+            
+    def used_rows(self):
+        return np.array(sorted(self.well_index.values()),dtype=int)
+        
+        
+    def volume(self,row):
+        return self.state[row,self.volume_column]
+        
+        
+    def transfer(self,source_row,dest_row,transfer_volume):
+        '''Move a Volume (and the Reagents Dissolved in It) Between Two Wells'''
+        transfer = self.state[source_row]*(transfer_volume/self.state[source_row,self.volume_column])
+        self.state[source_row] -= transfer
+        self.state[dest_row] += transfer
+        
+        
+    def to_frame(self):
+        '''DataFrame View of the Deck, Indexed by (Plate,Well)'''
+        rows = self.used_rows()
+        index = pd.MultiIndex.from_tuples([self.wells[row] for row in rows],names=['Plate','Well'])
+        return pd.DataFrame(self.state[rows],index=index,columns=self.columns)
+    
+
+#Index of Pure Source Wells, Kept Up To Date on Every Transfer
+class ReagentIndex(object):
+    
+    WATER = -1
+    
+    def __init__(self,deck,reagent_columns,exclude=()):
+        self.deck = deck
+        self.reagent_columns = reagent_columns
+        self.exclude = set(exclude)     #(plate,well) never used as a source, e.g. targets
+        self.kind = {}                  #row -> reagent column, WATER, or None for mixtures
+        self.sources = {column:set() for column in reagent_columns}
+        self.water = []                 #heap of (-volume,row), stale entries are skipped
+        
+        for row in deck.used_rows():
+            self.update(row)
+        
+        
+    def update(self,row):
+        '''Reclassify a Well After Its Contents Changed'''
+        if self.deck.wells[row] in self.exclude:
+            return
+        
+        contents = self.reagent_columns[self.deck.state[row,self.reagent_columns] != 0]
+        if len(contents) == 0:
+            kind = self.WATER
+        elif len(contents) == 1:
+            kind = contents[0]
+        else:
+            kind = None
+        
+        previous = self.kind.get(row)
+        if previous is not None and previous != self.WATER and previous != kind:
+            self.sources[previous].discard(row)
+        self.kind[row] = kind
+        
+        if kind == self.WATER:
+            heapq.heappush(self.water,(-self.deck.volume(row),row))
+        elif kind is not None:
+            self.sources[kind].add(row)
+            
+            
+    def reagent_wells(self,column):
+        return np.array(sorted(self.sources[column]),dtype=int)
+        
+        
+    def water_wells(self):
+        return np.array(sorted(row for row,kind in self.kind.items() if kind == self.WATER),dtype=int)
+        
+        
+    def find_water(self,transfer_volume):
+        '''Fullest Water Well, if It Holds Enough Volume For The Transfer'''
+        while self.water:
+            volume,row = self.water[0]
+            if self.kind.get(row) != self.WATER or -volume != self.deck.volume(row):
+                heapq.heappop(self.water)
+                continue
+            if -volume > transfer_volume + dead_volume:
+                return row
+            break
+        raise ValueError('Not Enough Water! Add More To Water Plate.')
+        
+        
+#Hands Out Mixing Wells, Spilling Over to New Mixing Plates When One Is Full
+class WellAllocator(object):
+    
+    def __init__(self,deck,plate='mixing_plate',plate_format=96,max_plates=None,transfer_limits=(min_transfer,max_transfer)):
+        if plate_format not in plate_formats:
+            raise ValueError('Unknown Plate Format: {} (Use One of {})'.format(plate_format,list(plate_formats)))
+        self.deck = deck
+        self.plate = plate
+        self.wells_per_plate = plate_format
+        self.max_plates = max_plates
+        self.min_transfer,self.max_transfer = transfer_limits
+        self.plates = []
+        self.used_wells = 0              #wells used on the last plate
+        self.dilutions = {}              #reagent column -> rows of dilution wells
+        
+        #Account For Mixing Wells Already On The Deck
+        existing = sum(1 for (p,_) in deck.well_index if p == plate)
+        if existing:
+            self.plates.append(plate)
+            self.used_wells = existing
+        
+        
+    def plate_name(self,number):
+        return self.plate if number == 1 else '{}_{}'.format(self.plate,number)
+        
+        
+    def allocate(self):
+        '''Next Free Well, as (plate,well)'''
+        if not self.plates or self.used_wells >= self.wells_per_plate:
+            if self.max_plates is not None and len(self.plates) >= self.max_plates:
+                raise ValueError('Too Many Wells: All {} Mixing Plates Are Full'.format(self.max_plates))
+            plate = self.plate_name(len(self.plates) + 1)
+            self.plates.append(plate)
+            self.deck.reserve(plate,self.wells_per_plate)
+            self.used_wells = 0
+            
+        self.used_wells += 1
+        return (self.plates[-1],self.used_wells)
+    
+    
+    def add_dilution(self,column,row):
+        self.dilutions.setdefault(column,[]).append(row)
+        
+        
+    def similar_dilutions(self,column,moles_needed):
+        '''Existing Dilution Wells That Still Have Room and Could Deliver moles_needed in One Transfer'''
+        rows = []
+        for row in self.dilutions.get(column,[]):
+            volume = self.deck.volume(row)
+            volume_needed = volume*moles_needed/self.deck.state[row,column]
+            if self.min_transfer < volume_needed <= self.max_transfer and volume < max_volume:
+                rows.append(row)
+        return rows
+    
+    
+#Append-Only Ledger of Single-Channel Transfers, Stored Column by Column
+class TransferLedger(object):
+    
+    columns = ['srcpos','srcwell','destpos','destwell','vol']
+    
+    def __init__(self):
+        self.srcpos = []
+        self.srcwell = []
+        self.destpos = []
+        self.destwell = []
+        self.vol = []
+        
+        
+    def __len__(self):
+        return len(self.vol)
+        
+        
+    def append(self,srcpos,srcwell,destpos,destwell,vol):
+        self.srcpos.append(srcpos)
+        self.srcwell.append(srcwell)
+        self.destpos.append(destpos)
+        self.destwell.append(destwell)
+        self.vol.append(float(vol))
+        
+        
+    def rows(self):
+        return zip(self.srcpos,self.srcwell,self.destpos,self.destwell,self.vol)
+        
+        
+    def to_frame(self):
+        return pd.DataFrame({column:getattr(self,column) for column in self.columns},columns=self.columns)
+    
 
 #Biomek Robot Object, Stores the State of the Robot and All plates that are on it.
 class BioMek(object):
     
-    def __init__(self,deck_df):
-        self.deck_df = deck_df.loc[~deck_df['Target'],deck_df.columns != 'Target']
+    def __init__(self,deck_df,mixing_plate_format=96,max_mixing_plates=None,tips=tips):
+        self.heads = select_tips(tips)
+        self.min_transfer,self.max_transfer = transfer_limits(self.heads)
+        self.deck = Deck.from_frame(deck_df.loc[~deck_df['Target'],deck_df.columns != 'Target'])
         self.goal_df = deck_df.loc[ deck_df['Target'],deck_df.columns != 'Target']
-        #self.water_wells =
+        self.reagents = [column for column in self.deck.columns if column != 'Volume']
+        self.reagent_columns = np.array([self.deck.columns.index(reagent) for reagent in self.reagents])
+        self.index = ReagentIndex(self.deck,self.reagent_columns,exclude=self.goal_df.index)
+        self.allocator = WellAllocator(self.deck,plate_format=mixing_plate_format,max_plates=max_mixing_plates,
+                                       transfer_limits=(self.min_transfer,self.max_transfer))
+        
+        self.ledger = TransferLedger()
+        
         
-        transfer_columns = ['srcpos','srcwell','destpos','destwell','vol']
-        self.transfer_df = pd.DataFrame(columns=transfer_columns)
+    @property
+    def deck_df(self):
+        return self.deck.to_frame()
         
         
+    @property
+    def transfer_df(self):
+        return self.ledger.to_frame()
+        
+        
+    @profiled('BioMek.transfer')
     def transfer(self, source_plate, source_well, dest_plate, dest_well, transfer_volume):
-        total_transfered = 0 #uL
+        source_row = self.deck.row(source_plate,source_well)
         
         #Check to see if there is enough volume for the transfer!
-        if transfer_volume > (self.deck_df.loc[(source_plate,source_well)]['Volume'] + dead_volume):
-            raise('Transfer Pulling Too Much Volume! {}'.format(transfer_volume))
+        if transfer_volume > (self.deck.volume(source_row) - dead_volume):
+            raise ValueError('Transfer Pulling Too Much Volume! {}'.format(transfer_volume))
         
         
         #Add Transfer To Ledger
+        self.record(source_plate,source_well,dest_plate,dest_well,transfer_volume)
+        
+        #Update Deck State
+        dest_row = self.deck.row(dest_plate,dest_well,create=True)
+        self.deck.transfer(source_row,dest_row,transfer_volume)
+        self.index.update(source_row)
+        self.index.update(dest_row)
+        
+        
+    def record(self, source_plate, source_well, dest_plate, dest_well, transfer_volume):
+        '''Add a Transfer To The Ledger, Split Into Pipette Sized Steps'''
+        num_rows = len(self.ledger)
+        total_transfered = 0 #uL
         while total_transfered < transfer_volume:
-            if transfer_volume - total_transfered > max_transfer:
-                values = [source_plate,source_well,dest_plate,dest_well,max_transfer]
-                total_transfered += max_transfer
+            if transfer_volume - total_transfered > self.max_transfer:
+                volume = self.max_transfer
             else:
-                values = [source_plate,source_well,dest_plate,dest_well,transfer_volume-total_transfered]
-                total_transfered += transfer_volume-total_transfered
+                volume = transfer_volume-total_transfered
+            total_transfered += volume
             
-            self.transfer_df = self.transfer_df.append(dict(zip(self.transfer_df.columns,values)),ignore_index=True)
-            
-        
-        #Update Deck State
-        source_composition = self.deck_df.xs((source_plate,source_well))
-        transfer = source_composition*(transfer_volume/source_composition['Volume'])
-
-        self.deck_df.loc[(source_plate,source_well)] -= transfer
-        try:
-            self.deck_df.loc[(dest_plate  ,dest_well  )] += transfer
-        except:
-            columns = self.deck_df.reset_index().columns
-            data = [dest_plate,dest_well] + [0]*(len(columns) - 2)
-            new_well = pd.DataFrame(dict(zip(columns,data)),index=[0]).set_index(['Plate','Well']) + transfer
-            self.deck_df = self.deck_df.append(new_well)
+            self.ledger.append(source_plate,source_well,dest_plate,dest_well,volume)
+        profile_count('ledger_rows',len(self.ledger) - num_rows)
             
     
     def get_well_state(self,plate,well):
-        
-        try:
-            return self.deck_df.loc[(dest_plate,dest_well)]
-        except:
-            columns = self.deck_df.reset_index().columns
-            data = [dest_plate,dest_well] + [0]*(len(columns) - 2)
-            new_well = pd.DataFrame(dict(zip(columns,data)),index=[0]).set_index(['Plate','Well'])
-            self.deck_df = self.deck_df.append(new_well)
-        return self.deck_df.loc[(dest_plate,dest_well)]
+        row = self.deck.row(plate,well,create=True)
+        return pd.Series(self.deck.state[row],index=self.deck.columns,name=(plate,well))
             
     
     def transfer_water(self,dest_plate,dest_well,transfer_volume):
         total_transfered = 0
         
         while total_transfered < transfer_volume:
-            if transfer_volume - total_transfered > max_transfer:
-                water_plate, water_well = self.find_water(max_transfer)
-                self.transfer(water_plate,water_well,dest_plate,dest_well,max_transfer)
-                total_transfered += max_transfer
+            if transfer_volume - total_transfered > self.max_transfer:
+                water_plate, water_well = self.find_water(self.max_transfer)
+                self.transfer(water_plate,water_well,dest_plate,dest_well,self.max_transfer)
+                total_transfered += self.max_transfer
             else:
                 water_plate, water_well = self.find_water(transfer_volume - total_transfered)
                 self.transfer(water_plate,water_well,dest_plate,dest_well,transfer_volume - total_transfered)
                 total_transfered += transfer_volume - total_transfered
                 
+                
+    def reagent_wells(self,reagent):
+        '''Rows of Wells Containing Only The Given Reagent'''
+        return self.index.reagent_wells(self.deck.columns.index(reagent))
             
-    def dilute(self,reagent_wells,solute,moles_needed,transfer_volume=ideal_transfer_volume):
+            
+    @profiled('BioMek.dilute')
+    def dilute(self,reagent_rows,solute,moles_needed,transfer_volume=ideal_transfer_volume):
         '''Creates a Diluted Version of the Source Plate'''
+        state = self.deck.state
+        column = self.deck.columns.index(solute)
         
         #Find The Right Well
-        ENOUGH_VOLUME = reagent_wells['Volume'] > min_volume * safety_factor + transfer_volume
-        reagent_wells = reagent_wells.loc[ENOUGH_VOLUME]
-        reagent_wells['dilution_factor'] = reagent_wells[solute]/reagent_wells['Volume']
+        ENOUGH_VOLUME = state[reagent_rows,self.deck.volume_column] > self.min_transfer * safety_factor + transfer_volume
+        reagent_rows = reagent_rows[ENOUGH_VOLUME]
+        volumes = state[reagent_rows,self.deck.volume_column]
+        moles = state[reagent_rows,column]
+        dilution_factor = moles/volumes
 
         #Calculate Required transfer volume
-        #source = reagent_wells['dilution_factor'].idxmin()
-        #source = self.deck_df.loc[(source_plate,source_well)]
-        #source_well_moles = source[solute]
-        
-        reagent_wells['dilution_volume'] = moles_needed*max_volume*reagent_wells['Volume']/(transfer_volume*reagent_wells[solute])
-        #display(reagent_wells)
-        reagent_wells = reagent_wells.loc[reagent_wells['dilution_volume'] < (reagent_wells['Volume'] - dead_volume)]
-        #display('after',reagent_wells)
-        
-        if len(reagent_wells) == 0:
-            reagent=solute
-            print(solute)
-            REAGENT_WELL = (self.deck_df.loc[:,~biomek.deck_df.columns.isin([reagent,'Volume'])] == 0).all(1)
-            CONTAINS_REAGENT = (biomek.deck_df.loc[:,biomek.deck_df.columns == reagent] > 0).any(1)
-            reagent_wells = self.deck_df.loc[REAGENT_WELL & CONTAINS_REAGENT]
-            display(reagent_wells)
-            raise('Not Enough {}! Add More To Reagent Plate.'.format(solute))        
-        
-        
-        source = reagent_wells['dilution_factor'].idxmin()
-        dilution_volume = max(min_volume,reagent_wells.loc[source]['dilution_volume'])
-        
-        #display(reagent_wells)
-        #print('Dilution Performed!, Volume: {}'.format(dilution_volume))
-        
-        #Check to see if dilution volume is above minimum volume
-        #if dilution_volume < min_volume:
-        #    dilution_volume = min_volume
-        
+        dilution_volumes = moles_needed*max_volume*volumes/(transfer_volume*moles)
+        ENOUGH_VOLUME = dilution_volumes < (volumes - dead_volume)
+        reagent_rows = reagent_rows[ENOUGH_VOLUME]
         
+        if len(reagent_rows) == 0:
+            raise ValueError('Not Enough {}! Add More To Reagent Plate.'.format(solute))        
         
+        source = np.argmin(dilution_factor[ENOUGH_VOLUME])
+        dilution_volume = max(self.min_transfer,dilution_volumes[ENOUGH_VOLUME][source])
+        source = reagent_rows[source]
+        source_concentration = state[source,column]/state[source,self.deck.volume_column]
+
+        #Top Up a Partially Used Dilution of a Similar Concentration, if There Is One
+        for row in self.allocator.similar_dilutions(column,moles_needed):
+            fill_volume = max_volume - state[row,self.deck.volume_column]
+            stock_volume = fill_volume*state[row,column]/state[row,self.deck.volume_column]/source_concentration
+            if self.min_transfer <= stock_volume < state[source,self.deck.volume_column] - dead_volume:
+                dilution_plate, dilution_well = self.deck.wells[row]
+                self.transfer(*self.deck.wells[source],dilution_plate,dilution_well,stock_volume)
+                self.transfer_water(dilution_plate,dilution_well,fill_volume - stock_volume)
+                profile_count('dilution_top_ups')
+                return
         
         #Transfer into New Well
         dilution_plate, dilution_well = self.allocate_well()
-        self.transfer(*source,dilution_plate,dilution_well,dilution_volume)
+        self.transfer(*self.deck.wells[source],dilution_plate,dilution_well,dilution_volume)
+        self.allocator.add_dilution(column,self.deck.row(dilution_plate,dilution_well))
+        profile_count('dilutions')
         
         #Fill With Water
         self.transfer_water(dilution_plate,dilution_well,max_volume - dilution_volume)
-        
+
+
+    def stock_concentrations(self,column):
+        '''Concentrations of The Wells Containing Only The Given Reagent'''
+        rows = self.index.reagent_wells(column)
+        state = self.deck.state[rows]
+        return rows,state[:,column]/state[:,self.deck.volume_column]
+
+
+    def plan_dilutions(self):
+        '''Plan One Shared Set of Dilutions per Reagent From Every Destination Well at Once
+
+        Each destination needing m moles can be served by any concentration in
+        [m/max_transfer, m/min_transfer). Going from the smallest m no stock well covers,
+        a level m/ideal_transfer_volume is added and serves every m up to
+        level*max_transfer, which keeps transfers near ideal_transfer_volume but is not
+        the smallest possible set of levels. Levels that are too dilute to be made from
+        any existing source in one step get serial intermediates.
+
+        Returns a list of (column, concentration, parent concentration, number of wells),
+        most concentrated first, so parents are always created before their children.
+        '''
+        plan = []
+        for reagent in self.reagents:
+            column = self.deck.columns.index(reagent)
+            moles = self.goal_df[reagent].values.astype(float)
+            moles = np.sort(moles[moles > 0])
+            _,stocks = self.stock_concentrations(column)
+            if len(moles) == 0 or len(stocks) == 0:
+                continue
+            stocks = np.unique(stocks)
+
+            #Stab The Intervals No Stock Covers, Smallest Upper Bound First
+            levels = []
+            unserved = moles[moles/stocks.min() <= self.min_transfer]
+            while len(unserved):
+                level = unserved[0]/ideal_transfer_volume
+                levels.append(level)
+                unserved = unserved[unserved/self.max_transfer > level]
+
+            #Add Serial Intermediates Until Every Level Can Be Made From a Source
+            parents = {}
+            pending = sorted(levels,reverse=True)
+            while pending:
+                level = pending.pop(0)
+                sources = np.concatenate([stocks,[l for l in levels if l > level]])
+                sources = sources[max_volume*level/sources >= self.min_transfer]
+                if len(sources):
+                    parents[level] = sources.min()
+                else:
+                    intermediate = min(l for l in np.concatenate([stocks,levels]) if l > level)*ideal_transfer_volume/max_volume
+                    levels.append(intermediate)
+                    pending = sorted(pending + [intermediate,level],reverse=True)
+            levels = np.array(sorted(levels,reverse=True))
+            if len(levels) == 0:
+                continue
+
+            #Volume Drawn From Each Level, Picking The Most Concentrated Usable One Like compile_media
+            demand = dict.fromkeys(levels,0.)
+            available = np.concatenate([stocks,levels])
+            for m in moles:
+                usable = available[m/available > self.min_transfer]
+                if len(usable) and usable.max() in demand:
+                    demand[usable.max()] += m/usable.max()
+
+            #Size Wells From The Most Dilute Level Up, Charging Each Parent For Its Children
+            wells = {}
+            for level in levels[::-1]:
+                wells[level] = int(math.ceil(demand[level]/(max_volume - dead_volume - self.max_transfer)))
+                if parents[level] in demand:
+                    demand[parents[level]] += wells[level]*max_volume*level/parents[level]
+
+            plan += [(column,level,parents[level],wells[level]) for level in levels if wells[level]]
+        return plan
+
+
+    @profiled('BioMek.prepare_dilutions')
+    def prepare_dilutions(self,plan=None):
+        '''Create The Planned Dilution Wells Up Front So Destination Wells Reuse Them'''
+        if plan is None:
+            plan = self.plan_dilutions()
+
+        for column,level,parent,num_wells in plan:
+            stock_volume = max_volume*level/parent
+            for _ in range(num_wells):
+
+                #Draw From The Fullest Well At The Parent Concentration, Matched With a Relative
+                #Tolerance Only Since Concentrations in mol/uL Are Far Below The Default atol
+                rows,concentrations = self.stock_concentrations(column)
+                rows = rows[np.isclose(concentrations,parent,rtol=1e-9,atol=0)]
+                volumes = self.deck.state[rows,self.deck.volume_column]
+                rows,volumes = rows[volumes - dead_volume > stock_volume],volumes[volumes - dead_volume > stock_volume]
+                if len(rows) == 0:
+                    raise ValueError('Not Enough {}! Add More To Reagent Plate.'.format(self.deck.columns[column]))
+                source = rows[np.argmax(volumes)]
+
+                dilution_plate, dilution_well = self.allocate_well()
+                self.transfer(*self.deck.wells[source],dilution_plate,dilution_well,stock_volume)
+                self.allocator.add_dilution(column,self.deck.row(dilution_plate,dilution_well))
+                self.transfer_water(dilution_plate,dilution_well,max_volume - stock_volume)
+                profile_count('dilutions')
+
+
+    @profiled('BioMek.plan_transfers')
+    def plan_transfers(self):
+        '''Every Transfer Into The Destination Wells, as Arrays of Source Rows, Destination Rows & Volumes
+
+        Phase one picks, for every reagent and destination at once, the most concentrated
+        pure well giving a transfer above min_transfer. Phase two packs those transfers first-fit
+        into the wells of each concentration, and the water top up into the water wells,
+        against their volume minus dead_volume. Transfers are ordered by destination, with the
+        reagents first and water last, like compile_media walks them.
+        '''
+        deck = self.deck
+        dest_rows = np.array([deck.row(plate,well,create=True) for plate,well in self.goal_df.index],dtype=int)
+        state = deck.state
+        sources,dests,volumes,steps = [np.zeros(0,dtype=int)],[np.zeros(0,dtype=int)],[np.zeros(0)],[np.zeros(0,dtype=int)]
+
+        for step,(reagent,column) in enumerate(zip(self.reagents,self.reagent_columns)):
+            moles = self.goal_df[reagent].values.astype(float)
+            needed = np.flatnonzero(moles > 0)
+            if len(needed) == 0:
+                continue
+            rows,concentrations = self.stock_concentrations(column)
+            if len(rows) == 0:
+                raise ValueError('No Valid Well For {} ({} moles)'.format(reagent,moles[needed[0]]))
+
+            #Phase One: Volume of Every Destination's Transfer From Each Concentration
+            levels = np.unique(concentrations)[::-1]
+            volume = moles[needed,None]/levels[None,:]
+
+            #Phase Two: Pack Transfers Into The Wells of The Most Concentrated Level Above The Minimum Volume,
+            #Falling Back to The Next Level Once Its Wells Are Used Up
+            pending = np.arange(len(needed))
+            for k,level in enumerate(levels):
+                taken = pending[volume[pending,k] > self.min_transfer]
+                wells = rows[concentrations == level]
+                assigned = pack_source_wells(volume[taken,k],state[wells,deck.volume_column] - dead_volume)
+                taken,assigned = taken[assigned >= 0],assigned[assigned >= 0]
+                sources.append(wells[assigned])
+                dests.append(needed[taken])
+                volumes.append(volume[taken,k])
+                steps.append(np.full(len(taken),step))
+                pending = np.setdiff1d(pending,taken)
+
+            if len(pending):
+                raise ValueError('Not Enough {}! Add More To Reagent Plate.'.format(reagent))
+
+        #Top Up With Water, in Steps of at Most max_transfer From The Fullest Water Wells
+        filled = state[dest_rows,deck.volume_column] + np.bincount(np.concatenate(dests),weights=np.concatenate(volumes),minlength=len(dest_rows))
+        water = self.goal_df['Volume'].values.astype(float) - filled
+        chunks = np.ceil(np.maximum(water,0)/self.max_transfer).astype(int)
+        water_dests = np.repeat(np.arange(len(dest_rows)),chunks)
+        chunk = np.arange(len(water_dests)) - np.repeat(np.cumsum(chunks) - chunks,chunks)
+        water_volumes = np.minimum(water[water_dests] - chunk*self.max_transfer,self.max_transfer)
+
+        wells = self.index.water_wells()
+        wells = wells[np.argsort(-state[wells,deck.volume_column],kind='stable')]
+        assigned = pack_source_wells(water_volumes,state[wells,deck.volume_column] - dead_volume)
+        if (assigned < 0).any():
+            raise ValueError('Not Enough Water! Add More To Water Plate.')
+        sources.append(wells[assigned])
+        dests.append(water_dests)
+        volumes.append(water_volumes)
+        steps.append(np.full(len(water_dests),len(self.reagents)))
+
+        dests,steps = np.concatenate(dests),np.concatenate(steps)
+        order = np.lexsort((steps,dests))
+        return np.concatenate(sources)[order],dest_rows[dests[order]],np.concatenate(volumes)[order]
+
+
+    @profiled('BioMek.apply_transfers')
+    def apply_transfers(self,source_rows,dest_rows,volumes):
+        '''Record a Batch of Transfers From Pure Wells & Update The Deck in One Pass'''
+        deck = self.deck
+
+        #Pure Wells Keep Their Concentration, So Each Transfer Moves a Fixed Fraction of The Source
+        contents = deck.state[source_rows]*(volumes/deck.state[source_rows,deck.volume_column])[:,None]
+        np.subtract.at(deck.state,source_rows,contents)
+        np.add.at(deck.state,dest_rows,contents)
+
+        for source,dest,volume in zip(source_rows,dest_rows,volumes):
+            self.record(*deck.wells[source],*deck.wells[dest],volume)
+        for row in np.unique(np.concatenate([source_rows,dest_rows])):
+            self.index.update(row)
+
+
+    def schedule(self,reuse='water',plate_columns=None,reservoirs=reservoir_plates):
+        '''Ledger Grouped Into Multichannel Steps (None If reuse Is None)
+
+        plate_columns overrides deck_plate_columns for the deck plates; the mixing plates take theirs from the mixing plate format.
+        '''
+        if reuse is None:
+            return None
+        columns = plate_formats[self.allocator.wells_per_plate][1]
+        plate_columns = {**deck_plate_columns,**(plate_columns or {}),**{plate:columns for plate in self.allocator.plates}}
+        return schedule_transfers(self.ledger,reuse=reuse,heads=self.heads,plate_columns=plate_columns,reservoirs=reservoirs)
+
 
     def allocate_well(self):
         '''Allocate a New Well'''
-        plate = 'mixing_plate'
-        try:
-            well = len(self.deck_df.loc[plate])+1
-        except:
-            well = 1
-            
-        if well > 96:
-            display(biomek.deck_df)
-            display(self.transfer_df)
-            raise('Too Many Wells: Implement New Plate Method')
-        return (plate,well)
+        return self.allocator.allocate()
     
+    @profiled('BioMek.find_water')
     def find_water(self,transfer_volume):
-        WATER_WELL = (self.deck_df.loc[:,~self.deck_df.columns.isin(['Volume'])] == 0).all(1) & (self.deck_df.loc[:,self.deck_df.columns == 'Volume'] > (transfer_volume+dead_volume)).any(1)
-        source = self.deck_df[WATER_WELL].iloc[0]
-        return source.name
+        profile_count('water_lookups')
+        return self.deck.wells[self.index.find_water(transfer_volume)]
     
     
 def concentration_to_moles(df):
@@ -181,128 +634,239 @@ def read_deckfile(deck_file):
     return deck_df
 
 
-def generate_biomek_csvs(biomek):
-    #Generate 5 CSVs for BIOMEK
-    water_mix_df  = biomek.transfer_df.loc[(biomek.transfer_df['destpos']=='mixing_plate') & (biomek.transfer_df['srcpos']=='water_plate')]
-    water_dest_df = biomek.transfer_df.loc[(biomek.transfer_df['destpos']=='dest_plate') & (biomek.transfer_df['srcpos']=='water_plate')]
-    mix_df =   biomek.transfer_df.loc[(biomek.transfer_df['destpos']=='mixing_plate') & (biomek.transfer_df['srcpos']!='water_plate')]
-    src_df = biomek.transfer_df.loc[(biomek.transfer_df['destpos']=='dest_plate') & (biomek.transfer_df['srcpos']=='src_plate')] 
-    dest_df =  biomek.transfer_df.loc[(biomek.transfer_df['destpos']=='dest_plate') & (biomek.transfer_df['srcpos']=='mixing_plate')]
+#Biomek CSVs, Keyed by (Source Plate, Destination Plate). None Matches Any Other Source Plate.
+biomek_csvs = {
+    ('water_plate','mixing_plate'):'water_mix.csv',
+    ('water_plate','dest_plate'):'water_dest.csv',
+    (None,'mixing_plate'):'mix.csv',
+    ('src_plate','dest_plate'):'src.csv',
+    ('mixing_plate','dest_plate'):'dest.csv',
+}
+
+
+def plate_type(plate):
+    '''Strip The Number Added to Extra Plates, e.g. mixing_plate_2 -> mixing_plate'''
+    return re.sub(r'_\d+$','',plate)
+
+
+def well_position(well,columns=12):
+    '''(Row, Column) of a Well Given as a 1-Based Row-Major Number or a Name Like 'B3' '''
+    match = re.match(r'^([A-Za-z])(\d+)$',str(well))
+    if match:
+        return ord(match.group(1).upper()) - ord('A'),int(match.group(2)) - 1
+    return divmod(int(well) - 1,columns)
+
+
+@profiled('schedule_transfers')
+def schedule_transfers(ledger,reuse='water',heads=None,channels=num_channels,plate_columns=None,water_plates=('water_plate',),reservoirs=()):
+    '''Group Transfers Into Multichannel Steps & Decide Which Ones Need a Fresh Tip
+
+    Transfers go to one of the heads (pipette_heads by default) by volume, as in core.choose_heads.
+    The probe of a transfer is the one over its destination row. Within a head, transfers
+    between the same plates and columns whose source rows are shifted from their destination
+    rows by the same amount are pipetted together, one per probe, in a single step (reservoirs
+    can feed any probe). A transfer out of a well waits for every earlier transfer into it, and
+    a transfer into a well waits for every earlier transfer out of it, so dilutions keep
+    their order. A probe keeps its tip when the reuse policy allows: 'never', 'water' (the tip
+    only touched water) or 'source' (also the same source well as the probe's previous transfer),
+    and never after dispensing into a well that already held something other than water.
+
+    Returns the transfers as a DataFrame in pipetting order, with 'head', 'step', 'probe' and 'new_tip' columns.
+    '''
+    if reuse not in tip_reuse_policies:
+        raise ValueError('Unknown Tip Reuse Policy: {} (Use One of {})'.format(reuse,tip_reuse_policies))
+    plate_columns = {} if plate_columns is None else plate_columns
+    heads = pipette_heads if heads is None else heads
+    df = ledger.to_frame()
+    
+    #Stage of Each Transfer From The Wells It Reads & Writes
+    depth,floor = {},{}
+    stage = np.zeros(len(df),dtype=int)
+    for i,(srcpos,srcwell,destpos,destwell,_) in enumerate(ledger.rows()):
+        src,dest = (srcpos,srcwell),(destpos,destwell)
+        stage[i] = max(depth.get(src,0),floor.get(dest,0))
+        floor[src] = max(floor.get(src,0),stage[i] + 1)
+        depth[dest] = max(depth.get(dest,0),stage[i] + 1)
+    
+    #Head, Rows & Columns
+    if len(df) and df['vol'].max() > heads[-1].max_volume:
+        raise ValueError('Transfer Too Large For Any Head! {}'.format(df['vol'].max()))
+    head_names = np.array([tip.head for tip in heads])
+    df['head'] = head_names[choose_heads(df['vol'].values,heads)]
+    src = np.array([well_position(well,plate_columns.get(plate,12)) for plate,well in zip(df['srcpos'],df['srcwell'])]).reshape(-1,2)
+    dest = np.array([well_position(well,plate_columns.get(plate,12)) for plate,well in zip(df['destpos'],df['destwell'])]).reshape(-1,2)
+    reservoir = df['srcpos'].isin(reservoirs).values
     
-    #line terminator required for csvs to be read by biomek software properly...
-    water_mix_df.to_csv('biomek_files/water_mix.csv',index=False,line_terminator='\r\n')
-    water_dest_df.to_csv('biomek_files/water_dest.csv',index=False,line_terminator='\r\n')
-    mix_df.to_csv('biomek_files/mix.csv',index=False,line_terminator='\r\n')
-    src_df.to_csv('biomek_files/src.csv',index=False,line_terminator='\r\n')
-    dest_df.to_csv('biomek_files/dest.csv',index=False,line_terminator='\r\n')
+    #Column Aligned Groups: Same Plates, Columns, Span of The Head Over The Destination Rows
+    #& Row Shift Between Source & Destination. Each Probe Takes One Transfer of a Group per Step
+    df['stage'] = stage
+    df['probe'] = dest[:,0] % channels
+    df['block'] = dest[:,0] // channels
+    df['shift'] = np.where(reservoir,0,src[:,0] - dest[:,0])
+    df['srccol'] = np.where(reservoir,-1,src[:,1])
+    df['destcol'] = dest[:,1]
+    df['group'] = df.groupby(['stage','head','srcpos','destpos','srccol','destcol','block','shift'],sort=False).ngroup()
+    df['round'] = df.groupby(['group','probe'],sort=False).cumcount()
+    df = df.sort_values(['stage','group','round','probe'],kind='stable')
+    df['step'] = df.groupby(['stage','group','round'],sort=False).ngroup()
+    
+    #Tips, Following Each Probe of Each Head Through The Run. A Dispense Into a Well Already
+    #Holding a Reagent (Anything But Water) Dirties The Tip Whatever The Policy
+    probes = [df['head'],df['probe']]
+    water = df['srcpos'].isin(water_plates)
+    dest_well = [df['destpos'],df['destwell']]
+    clean = (~water).astype(int).groupby(dest_well).cumsum() - (~water).astype(int) == 0
+    usable = clean.groupby(probes).shift(fill_value=False)
+    reused = water & water.groupby(probes).shift(fill_value=False)
+    if reuse == 'source':
+        reused |= (df['srcpos'] == df['srcpos'].groupby(probes).shift()) & (df['srcwell'] == df['srcwell'].groupby(probes).shift())
+    df['new_tip'] = True if reuse == 'never' else ~(reused & usable)
+    
+    return df[TransferLedger.columns + ['head','step','probe','new_tip']].reset_index(drop=True)
+
+
+def tip_report(schedule):
+    '''Predicted Transfers, Robot Steps, Tips & Tip Boxes per Head'''
+    grouped = schedule.groupby('head',sort=False)
+    report = pd.DataFrame({'Transfers':grouped.size(),'Steps':grouped['step'].nunique(),'Tips':grouped['new_tip'].sum()})
+    report['Tip Boxes'] = np.ceil(report['Tips']/tips_per_box).astype(int)
+    return report
+
+
+@profiled('generate_biomek_csvs')
+def generate_biomek_csvs(biomek,output_dir='biomek_files',schedule=None):
+    #Generate 5 CSVs for BIOMEK in a Single Pass Over the Ledger
+    os.makedirs(output_dir,exist_ok=True)
+    counts = dict.fromkeys(biomek_csvs.values(),0)
+    
+    with contextlib.ExitStack() as stack:
+        writers = {}
+        for key,filename in biomek_csvs.items():
+            #line terminator required for csvs to be read by biomek software properly...
+            f = stack.enter_context(open(os.path.join(output_dir,filename),'w',newline=''))
+            writers[key] = csv.writer(f,lineterminator='\r\n')
+            writers[key].writerow(TransferLedger.columns)
+        
+        if schedule is None:
+            rows = biomek.ledger.rows()
+        else:
+            rows = schedule[TransferLedger.columns].itertuples(index=False,name=None)
+        
+        for row in rows:
+            srcpos,destpos = plate_type(row[0]),plate_type(row[2])
+            key = (srcpos,destpos) if (srcpos,destpos) in writers else (None,destpos)
+            if key in writers:
+                writers[key].writerow(row)
+                counts[biomek_csvs[key]] += 1
     
     #Generate Tip Report
-    import math
     print('')
     print('Tips Needed By Subrutine')
     operations = ['Adding Water To Mixing Plate (Done with 8 tips in method)','Adding Water to Destination Plate (Done with 8 Tips)','Diluting Stock Solutions','Adding Undilute Media To Dest','Mixing Final Media']
-    for df,op in zip([water_mix_df,water_dest_df,mix_df,src_df,dest_df],operations):
-        boxes = math.ceil(len(df)/96)
-        print('{}: {} Tips,  {} Plates'.format(op,len(df),boxes))
+    for filename,op in zip(biomek_csvs.values(),operations):
+        boxes = math.ceil(counts[filename]/96)
+        print('{}: {} Tips,  {} Plates'.format(op,counts[filename],boxes))
 
-    total_tips = 16 + len(mix_df) + len(dest_df)
-    total_tips = len(biomek.transfer_df)
+    total_tips = len(biomek.ledger)
     print('')
     print('Overall Experiment Need')
     print('Total Tips Needed:',total_tips)
     print('Tip Plates Consumed:',math.ceil(total_tips/96))    
     
+    #Multichannel Prediction
+    if schedule is not None:
+        print('')
+        print('Scheduled For {} Channel Heads'.format(num_channels))
+        print(tip_report(schedule).to_string())
+    
 
-def compile_media(deck_df):
-    biomek = BioMek(deck_df)
-    #display(biomek.goal_df)
+@profiled('compile_media')
+def compile_media(deck_df,mixing_plate_format=96,max_mixing_plates=None,plan_dilutions=False,batch=False,tip_reuse=None,output_dir='biomek_files',tips=tips,plate_columns=None,reservoirs=reservoir_plates):
+    with profile_stage('compile_media.setup'):
+        biomek = BioMek(deck_df,mixing_plate_format=mixing_plate_format,max_mixing_plates=max_mixing_plates,tips=tips)
+    deck = biomek.deck
+
+    #Make The Shared Dilutions For The Whole Plate Before Any Destination Well (Batch Mode Only Draws From Existing Wells)
+    if plan_dilutions or batch:
+        biomek.prepare_dilutions()
+
+    #Plan Every Destination Well Up Front, Then Emit All Transfers in One Pass
+    if batch:
+        biomek.apply_transfers(*biomek.plan_transfers())
+        generate_biomek_csvs(biomek,output_dir=output_dir,schedule=biomek.schedule(tip_reuse,plate_columns=plate_columns,reservoirs=reservoirs))
+        return biomek
+    
     #Iterate Through Destination Wells
-    for (dest_plate,dest_well),solution in biomek.goal_df.iterrows():
-        #print(dest_plate,dest_well)
+    with profile_stage('compile_media.destination_wells'):
+        for (dest_plate,dest_well),solution in biomek.goal_df.iterrows():
 
-        #Find Solute & Moles Needed
-        for i,(reagent,moles) in enumerate(solution.loc[solution.index != 'Volume'].iteritems()):
-            while moles > 0:
+            #Find Solute & Moles Needed
+            for reagent,moles in solution.loc[solution.index != 'Volume'].items():
+                column = deck.columns.index(reagent)
+                while moles > 0:
 
-                #Get All Reagent Wells
-                REAGENT_WELL = (biomek.deck_df.loc[:,~biomek.deck_df.columns.isin([reagent,'Volume'])] == 0).all(1)
-                CONTAINS_REAGENT = (biomek.deck_df.loc[:,biomek.deck_df.columns == reagent] > 0).any(1)
-                reagent_wells = biomek.deck_df.loc[REAGENT_WELL & CONTAINS_REAGENT]
+                    #Get All Reagent Wells
+                    reagent_rows = biomek.reagent_wells(reagent)
 
-                #See There Are Enough Moles in The Reagent Wells ON Deck from any Well
-                reagent_wells = reagent_wells.loc[reagent_wells[reagent] > moles]
+                    #See There Are Enough Moles in The Reagent Wells ON Deck from any Well
+                    reagent_rows = reagent_rows[deck.state[reagent_rows,column] > moles]
 
 
-                if len(reagent_wells):
-                    #Find Wells require above the minimum pipette volume
-                    reagent_wells['volume_needed'] = reagent_wells['Volume']*(moles/reagent_wells[reagent])
-                    ENOUGH_VOLUME = (reagent_wells['Volume'] - dead_volume > reagent_wells['volume_needed'])
-                    source_wells = reagent_wells.loc[(reagent_wells['volume_needed'] > min_volume) & (reagent_wells[reagent] > moles) & ENOUGH_VOLUME]
+                    if len(reagent_rows):
+                        #Find Wells require above the minimum pipette volume
+                        volumes = deck.state[reagent_rows,deck.volume_column]
+                        volume_needed = volumes*(moles/deck.state[reagent_rows,column])
+                    
+                        #Find Wells With Enough Volume For Transfer
+                        ENOUGH_VOLUME = (volumes - dead_volume > volume_needed)
+                        SOURCE_WELL = (volume_needed > biomek.min_transfer) & ENOUGH_VOLUME
 
-                    #Find Wells With Enough Volume For Transfer
-                    source_wells = source_wells.loc[source_wells['volume_needed'] < (source_wells['Volume'] - dead_volume)]
+                        if SOURCE_WELL.any():
 
-                    if len(source_wells):
+                            #Get Least Dilute Well
+                            source = np.argmin(np.where(SOURCE_WELL,volume_needed,np.inf))
+                            transfer_volume = volume_needed[source]
 
-                        #Get Least Dilute Well
-                        source = source_wells['volume_needed'].idxmin()
-                        transfer_volume = source_wells.loc[source]['volume_needed']
-
-                        #Perform Transfer
-                        biomek.transfer(*source,dest_plate,dest_well,transfer_volume)
-
-                        break
-
-                    else:
-                        biomek.dilute(reagent_wells,reagent,moles,transfer_volume=ideal_transfer_volume)
+                            #Perform Transfer
+                            biomek.transfer(*deck.wells[reagent_rows[source]],dest_plate,dest_well,transfer_volume)
 
+                            break
 
+                        else:
+                            biomek.dilute(reagent_rows,reagent,moles,transfer_volume=ideal_transfer_volume)
 
 
-                else:
-                    print(solute,moles)
-                    display(reagent_wells)
-                    display(biomek.transfer_df)
-                    display(biomek.deck_df.loc['src_plate'])
-                    raise('No Valid Well')
+                    else:
+                        raise ValueError('No Valid Well For {} ({} moles)'.format(reagent,moles))
 
-        #Fill Remaining Volume with Water
-        transfer_volume = biomek.goal_df.loc[(dest_plate,dest_well)]['Volume'] - biomek.deck_df.loc[(dest_plate,dest_well)]['Volume']
-        biomek.transfer_water(dest_plate,dest_well,transfer_volume)
+            #Fill Remaining Volume with Water
+            dest_row = deck.row(dest_plate,dest_well,create=True)
+            transfer_volume = biomek.goal_df.loc[(dest_plate,dest_well)]['Volume'] - deck.volume(dest_row)
+            biomek.transfer_water(dest_plate,dest_well,transfer_volume)
         
-    #Create CSVs Needed
-    generate_biomek_csvs(biomek)
+    #Create CSVs Needed, Reordered For The Multichannel Heads if Asked
+    generate_biomek_csvs(biomek,output_dir=output_dir,schedule=biomek.schedule(tip_reuse,plate_columns=plate_columns,reservoirs=reservoirs))
+    return biomek
         
-def generate_initial_media(media_component_file,NUM_MEDIA=16,OVERLAY_VOLUME = 200,REAGENT_VOLUME = 1000,WELL_VOLUME = 1100,WATER_VOLUME = 1600,EXTRA_WELLS = {},OUTFILE='data/media.csv',DECKFILE='data/wells.csv',WATER_WELLS=96):
+def generate_initial_media(media_component_file,NUM_MEDIA=16,OVERLAY_VOLUME = 200,REAGENT_VOLUME = 1000,WELL_VOLUME = 1100,WATER_VOLUME = 1600,EXTRA_WELLS = {},OUTFILE='data/media.csv',DECKFILE='data/wells.csv',WATER_WELLS=96,CULTURE_VOLUME = 0):
     media_df = pd.read_csv(media_component_file)
     
-    #Create Source Plate
+    #Create Source Plate, Collecting Rows & Building The DataFrame Once
     columns = ['Plate','Well'] + [c for c in media_df['Media Components']] + ['Volume','Target']
-    df = pd.DataFrame(columns=columns)
+    rows = []
 
     #Work in mM concentrations
     well = 1
     for i,component in media_df.iterrows():    
-        if component['Media Components'] in EXTRA_WELLS:
-            for _ in range(EXTRA_WELLS[component['Media Components']]):
-                row = {'Plate':'src_plate',
-                       'Well':well,
-                       'Volume':REAGENT_VOLUME,
-                       'Target':False,
-                       component['Media Components']:component['Master Solution Concentration [M]']*1e3,
-                      }
-                df = df.append(row, ignore_index=True)
-                well +=1 
-        else:
-            row = {'Plate':'src_plate',
-                   'Well':well,
-                   'Volume':REAGENT_VOLUME,
-                   'Target':False,
-                   component['Media Components']:component['Master Solution Concentration [M]']*1e3,
-                  }
-            df = df.append(row, ignore_index=True)
+        for _ in range(EXTRA_WELLS.get(component['Media Components'],1)):
+            rows.append({'Plate':'src_plate',
+                         'Well':well,
+                         'Volume':REAGENT_VOLUME,
+                         'Target':False,
+                         component['Media Components']:component['Master Solution Concentration [M]']*1e3,
+                        })
             well +=1
-    df = df.fillna(0)
+    df = pd.DataFrame(rows,columns=columns).fillna(0)
     
     
     # Create DataFrame to Help Make Reagent Plate By Hand!
@@ -320,18 +884,22 @@ def generate_initial_media(media_component_file,NUM_MEDIA=16,OVERLAY_VOLUME = 20
     
     #Create Water Plate
     for i in range(WATER_WELLS):
-        row = {'Plate':'water_plate',
-               'Well':i+1,
-               'Volume':WATER_VOLUME,
-               'Target':False,
-              }
-        df = df.append(row, ignore_index=True)
-    df = df.fillna(0)
-
-    n=len(media_df)
-    media_array = lhs(n,NUM_MEDIA).tolist()
+        rows.append({'Plate':'water_plate',
+                     'Well':i+1,
+                     'Volume':WATER_VOLUME,
+                     'Target':False,
+                    })
+
     m_df = media_df
-    media_molarity = [((m_df['Max Concentration [mM]'] - m_df['Min Concentration [mM]'])* m + m_df['Min Concentration [mM]']).tolist() for m in media_array]  
+    master_molarity = m_df['Master Solution Concentration [M]'].values*1e3
+    
+    #Space Filling Designs, Keeping Only Those Whose Reagents Fit in The Well Next to The Culture & Overlay
+    reagent_fraction = (WELL_VOLUME - CULTURE_VOLUME - OVERLAY_VOLUME)/WELL_VOLUME
+    fits = lambda media: (media/master_molarity).sum(axis=1) <= reagent_fraction
+    media_array = sample_designs(m_df['Min Concentration [mM]'].values,m_df['Max Concentration [mM]'].values,NUM_MEDIA,feasible=fits)
+    if len(media_array) < NUM_MEDIA:
+        raise ValueError('Only {} of {} Media Fit in The Wells! Lower The Max Concentrations or Use Stronger Stocks.'.format(len(media_array),NUM_MEDIA))
+    media_molarity = media_array.tolist()
     #print(media_molarity)
 
     media_data = media_molarity
@@ -341,7 +909,8 @@ def generate_initial_media(media_component_file,NUM_MEDIA=16,OVERLAY_VOLUME = 20
         base_well = (math.floor((i)/8)*24 + (i) % 8) + 1
         for j in range(3):
             row = ['dest_plate',base_well + 8*j] + media_data[i] + [WELL_VOLUME,True]
-            df = df.append(dict(zip(columns,row)),ignore_index=True)
+            rows.append(dict(zip(columns,row)))
+    df = pd.DataFrame(rows,columns=columns).fillna(0)
             
     #Sort DF Columns By Concentration
     #sorted_components = media_df.sort_values('Min_Dilution_Factor')['Media Components']
@@ -354,4 +923,47 @@ def generate_initial_media(media_component_file,NUM_MEDIA=16,OVERLAY_VOLUME = 20
     well_df.to_csv(DECKFILE,index=False)
     df = df.set_index(['Plate','Well'])
     df = concentration_to_moles(df)
-    return df
\ No newline at end of file
+    return df
+
+
+def main(argv=None):
+    '''Compile a Deck File Into Biomek CSVs From The Command Line, e.g. python -m media_compiler data/wells.csv'''
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m media_compiler',description='Compile a deck file into Biomek transfer CSVs.')
+    parser.add_argument('deck_file',help='plates and wells with concentrations, volumes and a Target column')
+    parser.add_argument('--output-dir',default='biomek_files')
+    parser.add_argument('--mixing-plate-format',type=int,choices=sorted(plate_formats),default=96)
+    parser.add_argument('--max-mixing-plates',type=int)
+    parser.add_argument('--plan-dilutions',action='store_true',help='make shared dilutions for the whole plate up front')
+    parser.add_argument('--batch',action='store_true',help='plan all destination wells at once (implies --plan-dilutions)')
+    parser.add_argument('--tip-reuse',choices=tip_reuse_policies,help='order transfers for the multichannel heads')
+    parser.add_argument('--plate-columns',nargs='+',default=[],metavar='PLATE=COLUMNS',help='columns of a deck plate for --tip-reuse, e.g. dest_plate=8 (default: {})'.format(deck_plate_columns))
+    parser.add_argument('--reservoirs',nargs='*',default=list(reservoir_plates),metavar='PLATE',help='plates whose wells feed any probe for --tip-reuse (default: %(default)s)')
+    parser.add_argument('--tips',nargs='+',choices=sorted(tip_registry),default=tips,help='tips in use, one per head')
+    parser.add_argument('--deck-out',help='also write the final deck state to this CSV')
+    args = parser.parse_args(argv)
+    plate_columns = {}
+    for spec in args.plate_columns:
+        plate,_,columns = spec.partition('=')
+        if not columns.isdigit() or int(columns) == 0:
+            parser.error('--plate-columns takes PLATE=COLUMNS, got {}'.format(spec))
+        plate_columns[plate] = int(columns)
+
+    biomek = compile_media(read_deckfile(args.deck_file),
+                           mixing_plate_format=args.mixing_plate_format,
+                           max_mixing_plates=args.max_mixing_plates,
+                           plan_dilutions=args.plan_dilutions,
+                           batch=args.batch,
+                           tip_reuse=args.tip_reuse,
+                           output_dir=args.output_dir,
+                           tips=args.tips,
+                           plate_columns=plate_columns,
+                           reservoirs=tuple(args.reservoirs))
+    if args.deck_out is not None:
+        biomek.deck_df.to_csv(args.deck_out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
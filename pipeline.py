@@ -0,0 +1,375 @@
+"""Cached runner for the stock concentration, stock plate and transfer stages of a DBTL cycle.
+
+The stages follow notebooks A (stock concentrations, solubility), B (stock plate layouts)
+and D (volumes, stock plate volumes and transfers), built on the functions in `core`. Every
+stage output is stored in a cache directory under a key hashing the stage, the parameters it
+reads from `user_params`, the contents of its input files and the keys of the stages it
+depends on. Running a cycle again recomputes only the stages whose key changed, so editing
+e.g. the targets of a cycle does not redo the stock concentrations or stock plate layouts.
+
+Example::
+
+    run = run_cycle(user_params, cache_dir='../data/flaviolin/.pipeline_cache')
+    run.status                          # which stages were computed or loaded from the cache
+    run.artifacts['volumes'].volumes    # outputs by stage name
+"""
+
+import hashlib
+import os
+import pickle
+from typing import Callable, Dict, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+
+from core import (find_stock_concentrations, check_solubility, find_volumes_bulk, create_stock_plate,
+                  split_transfers, read_stock_concentrations, strip_unit, InfeasibleVolumesError)
+
+
+# Bump to invalidate all cached outputs, e.g. after changing what a stage computes
+cache_version = 1
+
+# Parameters used when `user_params` does not set them
+default_params = {
+    'stock_conc_file': None,        # fixed stock concentrations; found from the bounds when None
+    'culture_factor': 100,
+    'tips': ['f20', 'f200'],
+    'fresh_components': ['FeSO4'],  # components prepared fresh, on their own plate
+    'source_well_volume': 9000,     # volume of a stock plate well, including dead volume
+    'dead_volume': 100,
+}
+
+
+def fingerprint(value) -> str:
+    """Hash of a value built from DataFrames, arrays, containers and plain scalars."""
+    digest = hashlib.sha256()
+    _update(digest, value)
+    return digest.hexdigest()
+
+
+def _update(digest, value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        names = value.columns if isinstance(value, pd.DataFrame) else [value.name]
+        dtypes = [str(dtype) for dtype in np.atleast_1d(value.dtypes)]
+        _update(digest, (type(value).__name__, [str(name) for name in names], dtypes))
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        _update(digest, (value.dtype.str, value.shape))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b'dict')
+        for key in sorted(value, key=repr):
+            _update(digest, key)
+            _update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _update(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+
+def file_digest(path: str):
+    """Hash of the contents of a file, None without a file."""
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ArtifactCache(object):
+    """Stage outputs pickled in `directory`, one file per stage and key."""
+
+    def __init__(self, directory: str='.pipeline_cache'):
+        self.directory = directory
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(self.directory, f'{stage}-{key[:32]}.pkl')
+
+    def __contains__(self, item) -> bool:
+        return os.path.exists(self.path(*item))
+
+    def load(self, stage: str, key: str):
+        with open(self.path(stage, key), 'rb') as f:
+            return pickle.load(f)
+
+    def store(self, stage: str, key: str, value):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(stage, key)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+
+class Stage(NamedTuple):
+    """A pipeline stage: `func` gets the outputs of `inputs` and the parameters `params`
+    (including the paths in `files`, whose contents are part of the key) as keywords.
+
+    When the parameter `skip_if` is set the stage is not needed: it is not run, its files
+    are not read and stages using it get None."""
+    name: str
+    func: Callable
+    inputs: Tuple[str, ...] = ()
+    params: Tuple[str, ...] = ()
+    files: Tuple[str, ...] = ()
+    skip_if: str = None
+
+    def skipped(self, params: dict) -> bool:
+        return self.skip_if is not None and params.get(self.skip_if) is not None
+
+
+class PipelineRun(NamedTuple):
+    """Outputs of a run by stage name, with 'computed', 'cached' or 'skipped' for every stage run."""
+    artifacts: Dict[str, object]
+    status: Dict[str, str]
+    keys: Dict[str, str]
+
+
+# Stages
+
+def read_standard_recipe(standard_media_file):
+    return pd.read_csv(standard_media_file, index_col=0)
+
+
+def read_bounds(bounds_file):
+    return pd.read_csv(bounds_file, index_col=0)
+
+
+def stock_concentrations(standard_recipe, bounds, stock_conc_file, well_volume, min_transfer_volume,
+                         culture_factor):
+    """Stocks from `stock_conc_file` if given (see `read_stock_concentrations`; the bounds stage
+    is then skipped and `bounds` is None), found as in notebook A otherwise."""
+
+    if stock_conc_file is None:
+        return find_stock_concentrations(standard_recipe, bounds,
+                                         well_volume=well_volume,
+                                         min_tip_volume=min_transfer_volume,
+                                         culture_ratio=culture_factor,
+                                         verbose=False)
+
+    return read_stock_concentrations(stock_conc_file)
+
+
+def insoluble_components(stock_concentrations, standard_recipe):
+    """Components whose high stock is above their solubility, as in notebook A."""
+    if 'Solubility' not in standard_recipe.columns:
+        return []
+    df = pd.DataFrame({'Stock Concentration': stock_concentrations['High Concentration']})
+    solubility = standard_recipe['Solubility'].reindex(df.index)
+    return check_solubility(df, solubility=solubility, verbose=False)
+
+
+def stock_plate_layouts(stock_concentrations, fresh_components):
+    """High, low and fresh stock plate layouts, as in notebook B.
+
+    Components with a dilution factor above 1 get a well on the low plate; fresh components
+    get both stocks on the fresh plate, after the culture well.
+    """
+
+    df_stock = stock_concentrations
+    fresh = [comp for comp in df_stock.index if strip_unit(comp) in map(strip_unit, fresh_components)]
+    plated = df_stock.drop(index=fresh)
+    low = plated[plated['Dilution Factor'] > 1.]
+
+    def layout(components, concentrations):
+        return pd.DataFrame({'Component': list(components), 'Concentration[mM]': list(concentrations)})
+
+    fresh_rows = [('Culture', np.nan)] + [(comp, df_stock.at[comp, level])
+                                          for comp in fresh
+                                          for level in ('Low Concentration', 'High Concentration')]
+    return {'high': layout(plated.index, plated['High Concentration']),
+            'low': layout(low.index, low['Low Concentration']),
+            'fresh': layout(*zip(*fresh_rows))}
+
+
+def target_concentrations(target_conc_file, standard_recipe, stock_concentrations):
+    """Targets with the components missing from the file at their standard concentration,
+    in the order of the stocks (names are matched without unit suffixes)."""
+
+    df_target_conc = pd.read_csv(target_conc_file, index_col=0)
+    names = {strip_unit(comp): comp for comp in stock_concentrations.index}
+    df_target_conc = df_target_conc.rename(columns=lambda column: names.get(strip_unit(column), column))
+    for comp in stock_concentrations.index.drop(df_target_conc.columns, errors='ignore'):
+        df_target_conc[comp] = standard_recipe.at[comp, 'Concentration']
+    return df_target_conc[stock_concentrations.index].astype(float)
+
+
+def volumes(stock_concentrations, target_concentrations, well_volume, min_transfer_volume, culture_factor):
+    """`find_volumes_bulk` result with the status of every design."""
+    return find_volumes_bulk(stock_concentrations,
+                             df_target_conc=target_concentrations,
+                             well_volume=well_volume,
+                             min_tip_volume=min_transfer_volume,
+                             culture_ratio=culture_factor,
+                             return_result=True)
+
+
+def _check_feasible(volumes):
+    """Raise `InfeasibleVolumesError` with the designs and reasons if some designs cannot be made,
+    so a cycle never emits plates or transfers for them."""
+    infeasible = volumes.status[volumes.status != 0]
+    if len(infeasible):
+        raise InfeasibleVolumesError(np.bitwise_or.reduce(infeasible.values), designs=list(infeasible.index))
+
+
+def stock_plate_volumes(stock_plate_layouts, volumes, well_volume, culture_factor, source_well_volume,
+                        dead_volume, well_rows='ABCD', well_columns='123456'):
+    """Filled stock plates and the source well of every transfer, for each plate.
+
+    The high and low plates come from `create_stock_plate`; the fresh plate holds the
+    culture and both stocks of every fresh component, in one well each, named column-wise
+    like the other plates (A1, B1, ... D1, A2, ...).
+
+    :raises InfeasibleVolumesError: If some designs cannot be made.
+    :raises ValueError: If the fresh components do not fit on the fresh plate.
+    """
+
+    _check_feasible(volumes)
+    plates = {}
+    for level in ('high', 'low'):
+        plates[level] = create_stock_plate(stock_plate_layouts[level], volumes.volumes, volumes.conc_level,
+                                           conc_level=level,
+                                           well_volume=source_well_volume,
+                                           dead_volume=dead_volume)
+
+    df_fresh = stock_plate_layouts['fresh'].copy()
+    well_names = [f'{row}{column}' for column in well_columns for row in well_rows]
+    if len(df_fresh) > len(well_names):
+        raise ValueError(f'Fresh plate needs {len(df_fresh)} wells, but only has {len(well_names)}')
+    df_fresh['Well'] = well_names[:len(df_fresh)]
+    df_fresh['Stock'] = [None] + ['low', 'high'] * ((len(df_fresh) - 1) // 2)
+    df_source_wells = pd.DataFrame(None, index=volumes.volumes.index,
+                                   columns=df_fresh['Component'].unique(), dtype=object)
+    df_source_wells['Culture'] = df_fresh['Well'].iloc[0]
+    totals = [len(df_source_wells) * well_volume / culture_factor]
+    for _, row in df_fresh.iloc[1:].iterrows():
+        taken = (volumes.conc_level[row['Component']] == row['Stock']).values
+        df_source_wells.loc[taken, row['Component']] = row['Well']
+        totals.append(volumes.volumes[row['Component']].values[taken].sum())
+    df_fresh['Volume [uL]'] = np.ceil(totals) + dead_volume
+    plates['fresh'] = (df_fresh.drop(columns='Stock').set_index('Well'), df_source_wells)
+
+    return plates
+
+
+def transfers(volumes, stock_plate_volumes, well_volume, culture_factor, tips):
+    """Every sub-transfer for each head, with its source plate and well.
+
+    :return: DataFrame with 'Head', 'Source Plate', 'Source Well', 'Component',
+        'Destination Well' and 'Transfer Volume [uL]' columns, water first and culture last.
+    :raises InfeasibleVolumesError: If some designs cannot be made.
+    """
+
+    _check_feasible(volumes)
+    df_volumes = volumes.volumes.copy()
+    df_volumes['Culture'] = well_volume / culture_factor
+    components = list(df_volumes.columns)
+
+    source_plate = np.full(df_volumes.shape, None, dtype=object)
+    source_well = np.full(df_volumes.shape, None, dtype=object)
+    source_plate[:, components.index('Water')] = 'water'
+    source_well[:, components.index('Water')] = 'A1'   # reservoir
+    for plate, (_, df_source_wells) in stock_plate_volumes.items():
+        wells = df_source_wells.reindex(index=df_volumes.index, columns=components).values
+        taken = pd.notna(wells)
+        source_plate[taken] = plate
+        source_well[taken] = wells[taken]
+
+    order = [components.index('Water')] + [j for j, comp in enumerate(components) if comp != 'Water']
+    frames = []
+    for head, sub in split_transfers(df_volumes.values[:, order], tips=tips).items():
+        component = np.array(order)[sub.component]
+        frames.append(pd.DataFrame({'Head': head,
+                                    'Source Plate': source_plate[sub.well, component],
+                                    'Source Well': source_well[sub.well, component],
+                                    'Component': np.array(components, dtype=object)[component],
+                                    'Destination Well': df_volumes.index[sub.well],
+                                    'Transfer Volume [uL]': sub.volume}))
+    return pd.concat(frames, ignore_index=True)
+
+
+cycle_stages = (
+    Stage('standard_recipe', read_standard_recipe, files=('standard_media_file',)),
+    Stage('bounds', read_bounds, files=('bounds_file',), skip_if='stock_conc_file'),
+    Stage('stock_concentrations', stock_concentrations,
+          inputs=('standard_recipe', 'bounds'),
+          params=('well_volume', 'min_transfer_volume', 'culture_factor'),
+          files=('stock_conc_file',)),
+    Stage('insoluble_components', insoluble_components, inputs=('stock_concentrations', 'standard_recipe')),
+    Stage('stock_plate_layouts', stock_plate_layouts, inputs=('stock_concentrations',), params=('fresh_components',)),
+    Stage('target_concentrations', target_concentrations,
+          inputs=('standard_recipe', 'stock_concentrations'),
+          files=('target_conc_file',)),
+    Stage('volumes', volumes,
+          inputs=('stock_concentrations', 'target_concentrations'),
+          params=('well_volume', 'min_transfer_volume', 'culture_factor')),
+    Stage('stock_plate_volumes', stock_plate_volumes,
+          inputs=('stock_plate_layouts', 'volumes'),
+          params=('well_volume', 'culture_factor', 'source_well_volume', 'dead_volume')),
+    Stage('transfers', transfers,
+          inputs=('volumes', 'stock_plate_volumes'),
+          params=('well_volume', 'culture_factor', 'tips')),
+)
+
+
+def stage_keys(stages, params: dict) -> Dict[str, str]:
+    """Key of every stage, from its parameters, input file contents and the keys of its inputs."""
+    keys = {}
+    for stage in stages:
+        if stage.skipped(params):
+            keys[stage.name] = fingerprint((cache_version, stage.name, 'skipped'))
+            continue
+        keys[stage.name] = fingerprint((cache_version,
+                                        stage.name,
+                                        [(name, params.get(name)) for name in stage.params],
+                                        [(name, file_digest(params.get(name))) for name in stage.files],
+                                        [keys[name] for name in stage.inputs]))
+    return keys
+
+
+def run_cycle(user_params: dict,
+              cache_dir: str='.pipeline_cache',
+              stages=cycle_stages,
+              targets=None,
+              force=()) -> PipelineRun:
+    """Run the stages needed for `targets` (all stages by default), reusing cached outputs.
+
+    :param user_params: Parameters and input files of the cycle, as in the notebooks
+        ('standard_media_file', 'bounds_file', 'target_conc_file', 'well_volume',
+        'min_transfer_volume', ...); missing ones are taken from `default_params`.
+        'bounds_file' is only needed without a 'stock_conc_file'.
+    :param cache_dir: Directory of the cached stage outputs.
+    :param stages: Stages in dependency order.
+    :param targets: Names of the stages whose outputs are wanted.
+    :param force: Names of stages computed even when cached.
+    :return: PipelineRun with the outputs of the stages that were run or loaded.
+    """
+
+    params = {**default_params, **user_params}
+    by_name = {stage.name: stage for stage in stages}
+    keys = stage_keys(stages, params)
+    cache = ArtifactCache(cache_dir)
+    artifacts, status = {}, {}
+
+    def get(name):
+        if name in artifacts:
+            return artifacts[name]
+        stage, key = by_name[name], keys[name]
+        if stage.skipped(params):
+            artifacts[name] = None
+            status[name] = 'skipped'
+        elif name not in force and (name, key) in cache:
+            artifacts[name] = cache.load(name, key)
+            status[name] = 'cached'
+        else:
+            kwargs = {input_name: get(input_name) for input_name in stage.inputs}
+            kwargs.update({param: params.get(param) for param in stage.params + stage.files})
+            artifacts[name] = stage.func(**kwargs)
+            cache.store(name, key, artifacts[name])
+            status[name] = 'computed'
+        return artifacts[name]
+
+    for name in (targets if targets is not None else [stage.name for stage in stages]):
+        get(name)
+
+    return PipelineRun(artifacts, status, keys)